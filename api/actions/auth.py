@@ -1,58 +1,127 @@
-from datetime import datetime
+from uuid import UUID
 
+from fastapi import BackgroundTasks
 from fastapi import Depends
 from fastapi import HTTPException
 from fastapi.security import OAuth2PasswordBearer
-from jose import jwt
-from jose import JWTError
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 
 import settings
 from db.dals import UserDAL
 from db.models import User
+from db.session import database
+from db.session import get_async_read_session
 from db.session import get_async_session
+from db.session import is_replica_session
 from hashing import Hasher
+from security import decode_access_token
+from security import TokenError
 
 oauth2_schema = OAuth2PasswordBearer(tokenUrl="/login/token")
 
 
 async def _get_user_by_email_for_auth(email: str, session: AsyncSession) -> User | None:
+    """never cached, a deleted or demoted user must not authenticate as before"""
     user_dal = UserDAL(session)
-    return await user_dal.get_user_by_email(email)
+    return await user_dal.get_user_by_email(email, cached=False)
+
+
+async def _rehash_password(user_id: UUID, password: str, session: AsyncSession):
+    """stores a hash made with the current scheme and cost settings"""
+    user_dal = UserDAL(session)
+    await user_dal.update_user(user_id, password=password)
 
 
 async def authenticate_user(
-    email: str, password: str, session: AsyncSession
+    email: str,
+    password: str,
+    session: AsyncSession,
+    background_tasks: BackgroundTasks | None = None,
 ) -> User | None:
     user = await _get_user_by_email_for_auth(email, session)
     if not user:
         return
-    return user if Hasher.verify_password(password, user.password) else None
+    verified, new_hash = await Hasher.verify_and_update_async(password, user.password)
+    if not verified:
+        return
+    if new_hash and background_tasks is not None:
+        background_tasks.add_task(_rehash_password, user.id, new_hash, session)
+    return user
 
 
-async def get_current_user_from_token(
-    token: str = Depends(oauth2_schema),
-    session: AsyncSession = Depends(get_async_session),
-) -> User | None:
+async def _get_token_version(user_id: UUID, session: AsyncSession) -> int | None:
+    """read on the primary, a replica may not have seen a revocation yet"""
+    if is_replica_session(session):
+        async with database.session() as primary_session:
+            return await UserDAL(primary_session).get_token_version(user_id)
+    return await UserDAL(session).get_token_version(user_id)
+
+
+async def _get_user_from_claims(payload: dict, session: AsyncSession) -> User | None:
+    """Builds a detached principal from stateless claims, None if revoked.
+
+    Only the token version of the user is read, by primary key.
+    """
+    try:
+        user_id = UUID(payload["uid"])
+    except (TypeError, ValueError):
+        return
+    if payload.get("ver") != await _get_token_version(user_id, session):
+        return
+    return User(
+        id=user_id,
+        name=payload.get("name"),
+        surname=payload.get("surname"),
+        email=payload.get("sub"),
+        roles=payload.get("roles", []),
+        is_active=True,
+        version=payload.get("rev"),
+    )
+
+
+async def _get_current_user(token: str, session: AsyncSession) -> User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
     )
     try:
-        payload = jwt.decode(
-            token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM]
-        )
+        payload = decode_access_token(token)
         email = payload.get("sub")
-        expires = datetime.fromtimestamp(payload.get("exp"))
-        print(f"Token will expire in {expires}")
         if not email:
             raise credentials_exception
-    except JWTError:
+    except TokenError:
         raise credentials_exception
+    if settings.STATELESS_AUTH and "uid" in payload:
+        user = await _get_user_from_claims(payload, session)
+        if not user:
+            raise credentials_exception
+        return user
     user = await _get_user_by_email_for_auth(email, session)
+    if not user and is_replica_session(session):
+        # the replica may lag behind a signup or reactivation
+        async with database.session() as primary_session:
+            user = await _get_user_by_email_for_auth(email, primary_session)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST, detail="You are deleted!"
         )
     return user
+
+
+async def get_current_user_from_token(
+    token: str = Depends(oauth2_schema),
+    session: AsyncSession = Depends(get_async_read_session),
+) -> User:
+    return await _get_current_user(token, session)
+
+
+async def get_current_user_for_write(
+    token: str = Depends(oauth2_schema),
+    session: AsyncSession = Depends(get_async_session),
+) -> User:
+    """Authenticates on the request's primary session, for write routes.
+
+    A replica could still show a just demoted admin as one.
+    """
+    return await _get_current_user(token, session)
@@ -1,34 +1,77 @@
+from typing import AsyncIterator
 from uuid import UUID
 
-from fastapi import HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
 
+import settings
+from api.schemas import BulkCreateStatus
 from api.schemas import UserCreate
+from api.serializers import dumps
+from api.serializers import serialize_user_show
+from db.dals import CreateResult
+from db.dals import MutationResult
 from db.dals import PortalRole
 from db.dals import UserDAL
 from db.models import User
 from hashing import Hasher
 
 
-async def _create_new_user(body: UserCreate, session: AsyncSession) -> User | None:
-    # async with session.begin():
+async def _create_new_user(body: UserCreate, session: AsyncSession) -> CreateResult:
     user_dal = UserDAL(session)
-    user = await user_dal.create_user(
+    result = await user_dal.create_user(
         name=body.name,
         surname=body.surname,
         email=body.email,
-        password=Hasher.get_password_hash(body.password),
+        password=await Hasher.get_password_hash_async(body.password),
         roles=[
             PortalRole.ROLE_USER,
         ],
     )
-    return user
+    return result
 
 
-async def _delete_user(user_id: UUID, session: AsyncSession) -> User | None:
+async def _create_users_bulk(
+    bodies: list[UserCreate], session: AsyncSession
+) -> dict[str, BulkCreateStatus]:
+    """creates users by email, only passwords of brand-new users get hashed"""
     user_dal = UserDAL(session)
-    user = await user_dal.delete_user(user_id)
-    return user
+    unique_bodies = {}
+    for body in bodies:
+        unique_bodies.setdefault(body.email, body)
+    existing = await user_dal.get_email_activity(list(unique_bodies))
+    to_reactivate = [email for email, is_active in existing.items() if not is_active]
+    to_create = [body for body in unique_bodies.values() if body.email not in existing]
+    # ends the read transaction, its connection must not sit idle while hashing
+    await session.commit()
+    passwords = await Hasher.get_password_hashes_async(
+        [body.password for body in to_create]
+    )
+    reactivated, created = await user_dal.create_users_bulk(
+        reactivate=to_reactivate,
+        new_users=[
+            dict(
+                name=body.name,
+                surname=body.surname,
+                email=body.email,
+                password=password,
+                roles=[PortalRole.ROLE_USER],
+            )
+            for body, password in zip(to_create, passwords)
+        ],
+        batch_size=settings.USER_BULK_BATCH_SIZE,
+    )
+    statuses = dict.fromkeys(unique_bodies, BulkCreateStatus.CONFLICT)
+    statuses.update(dict.fromkeys(reactivated, BulkCreateStatus.REACTIVATED))
+    statuses.update(dict.fromkeys(created, BulkCreateStatus.CREATED))
+    return statuses
+
+
+async def _delete_user(
+    user_id: UUID, current_user: User, session: AsyncSession
+) -> MutationResult:
+    user_dal = UserDAL(session)
+    result = await user_dal.delete_user_as(user_id, actor=current_user)
+    return result
 
 
 async def _get_user_by_id(user_id: UUID, session: AsyncSession) -> User | None:
@@ -37,23 +80,87 @@ async def _get_user_by_id(user_id: UUID, session: AsyncSession) -> User | None:
     return user
 
 
+async def _get_users_by_ids(user_ids: list[UUID], session: AsyncSession) -> list[User]:
+    user_dal = UserDAL(session)
+    users = await user_dal.get_users_by_ids(user_ids)
+    return users
+
+
+async def _list_users(
+    limit: int,
+    after: UUID | None,
+    is_active: bool | None,
+    role: PortalRole | None,
+    session: AsyncSession,
+) -> list[User]:
+    user_dal = UserDAL(session)
+    users = await user_dal.list_users(
+        limit=limit, after=after, is_active=is_active, role=role
+    )
+    return users
+
+
+async def _search_users(
+    query: str,
+    limit: int,
+    after: tuple[float, UUID] | None,
+    session: AsyncSession,
+) -> list[tuple[User, float]]:
+    user_dal = UserDAL(session)
+    return await user_dal.search_users(query, limit=limit, after=after)
+
+
+async def _stream_users_ndjson(
+    after: UUID | None,
+    is_active: bool | None,
+    role: PortalRole | None,
+    session: AsyncSession,
+) -> AsyncIterator[bytes]:
+    user_dal = UserDAL(session)
+    users = user_dal.stream_users(
+        chunk_size=settings.USER_STREAM_CHUNK_SIZE,
+        after=after,
+        is_active=is_active,
+        role=role,
+    )
+    async for user in users:
+        yield dumps(serialize_user_show(user)) + b"\n"
+
+
+async def _get_user_version(user_id: UUID, session: AsyncSession) -> int | None:
+    user_dal = UserDAL(session)
+    version = await user_dal.get_user_version(user_id)
+    return version
+
+
 async def _update_user(
-    user_id: UUID, updated_user_params: dict, session: AsyncSession
-) -> User | bool | None:
+    user_id: UUID,
+    updated_user_params: dict,
+    current_user: User,
+    session: AsyncSession,
+    expected_version: int | None = None,
+) -> MutationResult:
     user_dal = UserDAL(session)
-    user = await user_dal.update_user(user_id, **updated_user_params)
-    return user
+    result = await user_dal.update_user_as(
+        user_id,
+        actor=current_user,
+        expected_version=expected_version,
+        **updated_user_params,
+    )
+    return result
 
 
-def check_user_permissions(target_user: User, current_user: User) -> bool:
-    if target_user.is_superadmin:
-        raise HTTPException(
-            status_code=406, detail="Superadmin cannot be deleted via API."
-        )
-    print(current_user)
-    if target_user.id != current_user.id:
-        if not any((current_user.is_admin, current_user.is_superadmin)):
-            return False
-        if current_user.is_admin & target_user.is_admin:
-            return False
-    return True
+async def _grant_admin_privilege(
+    user_id: UUID, session: AsyncSession
+) -> MutationResult:
+    user_dal = UserDAL(session)
+    result = await user_dal.grant_admin_privilege(user_id)
+    return result
+
+
+async def _revoke_admin_privilege(
+    user_id: UUID, session: AsyncSession
+) -> MutationResult:
+    user_dal = UserDAL(session)
+    result = await user_dal.revoke_admin_privilege(user_id)
+    return result
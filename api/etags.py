@@ -0,0 +1,29 @@
+from uuid import UUID
+
+
+def user_etag(user_id: UUID, version: int, secure: bool = False) -> str:
+    """strong ETag of a user representation, secure for the UserShowSecure one"""
+    suffix = "-s" if secure else ""
+    return f'"{user_id.hex}-{version}{suffix}"'
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """If-None-Match uses the weak comparison"""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(
+        tag.strip().removeprefix("W/") == etag for tag in if_none_match.split(",")
+    )
+
+
+def version_from_if_match(if_match: str, user_id: UUID) -> int | None:
+    """version the client expects, None if no tag is a strong ETag of this user"""
+    for tag in if_match.split(","):
+        tag = tag.strip()
+        if not (tag.startswith('"') and tag.endswith('"')):
+            continue
+        user_hex, _, version = tag.strip('"').removesuffix("-s").partition("-")
+        if user_hex == user_id.hex and version.isdigit():
+            return int(version)
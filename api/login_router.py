@@ -1,8 +1,11 @@
+import math
 from datetime import timedelta
 
 from fastapi import APIRouter
+from fastapi import BackgroundTasks
 from fastapi import Depends
 from fastapi import HTTPException
+from fastapi import Request
 from fastapi.security.oauth2 import OAuth2PasswordRequestForm
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
@@ -10,18 +13,32 @@ from starlette import status
 import settings
 from api.actions.auth import authenticate_user
 from api.schemas import Token
+from api.throttling import login_throttle
 from db.session import get_async_session
 from security import create_access_token
+from security import stateless_claims
 
 login_router = APIRouter()
 
 
 @login_router.post("/token")
 async def login_for_access_token(
+    request: Request,
+    background_tasks: BackgroundTasks,
     form_data: OAuth2PasswordRequestForm = Depends(),
     session: AsyncSession = Depends(get_async_session),
 ) -> Token:
-    user = await authenticate_user(form_data.username, form_data.password, session)
+    client_ip = request.client.host if request.client else None
+    retry_after = login_throttle.acquire(form_data.username, client_ip)
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many login attempts.",
+            headers={"Retry-After": str(math.ceil(retry_after))},
+        )
+    user = await authenticate_user(
+        form_data.username, form_data.password, session, background_tasks
+    )
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -29,8 +46,11 @@ async def login_for_access_token(
         )
 
     access_token_expires = timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
+    data = {"sub": user.email, "other_custom_data": [1, 2, 3, 4]}
+    if settings.STATELESS_AUTH:
+        data.update(stateless_claims(user))
     access_token = create_access_token(
-        data={"sub": user.email, "other_custom_data": [1, 2, 3, 4]},
+        data=data,
         expires_delta=access_token_expires,
     )
     return Token(access_token=access_token, token_type="bearer")
@@ -1,14 +1,17 @@
 # region API models
 import re
 import uuid
+from enum import Enum
 
 from pydantic import BaseModel
+from pydantic import conlist
 from pydantic import EmailStr
 from pydantic import Field
 
 from db.models import PortalRole
 
 LETTER_MATCH_PATTERN = re.compile(r"^[а-яА-Яa-zA-Z\-]+$")
+USER_BATCH_MAX_SIZE = 100
 
 
 class TunedModel(BaseModel):
@@ -30,6 +33,29 @@ class UserShow(UserShowSecure):
     is_active: bool
 
 
+class UserBatchRequest(BaseModel):
+    ids: conlist(uuid.UUID, min_items=1, max_items=USER_BATCH_MAX_SIZE)
+
+
+class UserBatchShow(TunedModel):
+    users: list[UserShow]
+    missing: list[uuid.UUID]
+
+
+class UserPage(TunedModel):
+    users: list[UserShow]
+    next_cursor: uuid.UUID | None
+
+
+class UserSearchHit(UserShow):
+    score: float
+
+
+class UserSearchPage(TunedModel):
+    users: list[UserSearchHit]
+    next_cursor: str | None
+
+
 class UserCreate(BaseModel):
     name: str = Field(
         regex=LETTER_MATCH_PATTERN,
@@ -45,6 +71,28 @@ class UserCreate(BaseModel):
     password: str
 
 
+class BulkCreateStatus(str, Enum):
+    CREATED = "created"
+    REACTIVATED = "reactivated"
+    CONFLICT = "conflict"
+    INVALID = "invalid"
+
+
+class UserBulkCreateRow(BaseModel):
+    index: int
+    email: str | None
+    status: BulkCreateStatus
+    detail: str | None = None
+
+
+class UserBulkCreateResult(BaseModel):
+    created: int
+    reactivated: int
+    conflicts: int
+    invalid: int
+    rows: list[UserBulkCreateRow]
+
+
 class UpdateUserRequest(BaseModel):
     name: str | None = Field(
         regex=LETTER_MATCH_PATTERN, description="Name must contain only letters"
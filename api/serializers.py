@@ -0,0 +1,71 @@
+"""Response serialization that skips pydantic validation for database rows.
+
+Rows loaded from the database were validated on the way in, so the response
+models are compiled into plain attribute readers and written with orjson
+when it is installed. The pydantic models remain the OpenAPI contract.
+"""
+import json
+import uuid
+from enum import Enum
+from operator import attrgetter
+from typing import Any
+from typing import Callable
+
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from pydantic.fields import SHAPE_LIST
+
+from api.schemas import UserShow
+from api.schemas import UserShowSecure
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _enum_values(values: list) -> list:
+    return [getattr(value, "value", value) for value in values]
+
+
+def _converter(field) -> Callable[[Any], Any] | None:
+    """turns a field value into a JSON native one, None if it already is"""
+    if field.shape == SHAPE_LIST and issubclass(field.type_, Enum):
+        return _enum_values
+    if field.type_ is uuid.UUID:
+        return str
+    return None
+
+
+def compile_serializer(model: type[BaseModel]) -> Callable[[Any], dict]:
+    """dict of the model's fields read straight from an ORM object"""
+    readers = [
+        (name, attrgetter(name), _converter(field))
+        for name, field in model.__fields__.items()
+    ]
+
+    def serialize(obj) -> dict:
+        data = {}
+        for name, read, convert in readers:
+            value = read(obj)
+            data[name] = convert(value) if convert and value is not None else value
+        return data
+
+    return serialize
+
+
+serialize_user_show = compile_serializer(UserShow)
+serialize_user_show_secure = compile_serializer(UserShowSecure)
+
+
+def dumps(content: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+class FastJSONResponse(JSONResponse):
+    """JSON response for content that is already JSON native"""
+
+    def render(self, content: Any) -> bytes:
+        return dumps(content)
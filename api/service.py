@@ -1,4 +1,12 @@
+import asyncio
+
 from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+
+import settings
+from metrics import read_snapshots
+from metrics import registry
+from metrics import write_snapshot
 
 service_router = APIRouter()
 
@@ -6,3 +14,17 @@ service_router = APIRouter()
 @service_router.get("/ping")
 async def ping():
     return {"success": True}
+
+
+@service_router.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    directory = settings.METRICS_DIR
+    if directory:
+        # all workers, this worker's values as of now and the others' as of
+        # their last flush
+        await asyncio.to_thread(write_snapshot, directory, registry.snapshot())
+        snapshots = await asyncio.to_thread(read_snapshots, directory)
+        text = registry.render_snapshots(snapshots)
+    else:
+        text = registry.render()
+    return PlainTextResponse(text, media_type="text/plain; version=0.0.4")
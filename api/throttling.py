@@ -0,0 +1,74 @@
+import time
+from collections import OrderedDict
+
+import settings
+
+
+class TokenBucketLimiter:
+    """Token bucket per key.
+
+    Buckets live in shards that each keep at most ``max_keys / shards`` keys and
+    evict the least recently used one, so memory stays bounded however many
+    distinct keys an attacker sends.
+    """
+
+    def __init__(
+        self, rate_per_minute: float, burst: int, max_keys: int, shards: int = 16
+    ):
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self._shards: list[OrderedDict[str, tuple[float, float]]] = [
+            OrderedDict() for _ in range(shards)
+        ]
+        self._max_keys_per_shard = max(1, max_keys // shards)
+
+    def acquire(self, key: str) -> float:
+        """takes a token, returns 0 or the seconds until one is available"""
+        shard = self._shards[hash(key) % len(self._shards)]
+        now = time.monotonic()
+        tokens, updated = shard.get(key, (self.burst, now))
+        tokens = min(self.burst, tokens + (now - updated) * self.rate)
+        retry_after = 0.0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            retry_after = (1 - tokens) / self.rate
+        shard[key] = (tokens, now)
+        shard.move_to_end(key)
+        if len(shard) > self._max_keys_per_shard:
+            shard.popitem(last=False)
+        return retry_after
+
+
+class LoginThrottle:
+    """Limits login attempts per email and per client IP.
+
+    Buckets are kept per server worker, so with several workers a client gets
+    up to the limits once per worker it reaches.
+    """
+
+    def __init__(self):
+        self.enabled = settings.LOGIN_THROTTLE_ENABLED
+        self.by_email = TokenBucketLimiter(
+            settings.LOGIN_EMAIL_RATE_PER_MINUTE,
+            settings.LOGIN_EMAIL_BURST,
+            max_keys=settings.LOGIN_THROTTLE_MAX_KEYS,
+        )
+        self.by_ip = TokenBucketLimiter(
+            settings.LOGIN_IP_RATE_PER_MINUTE,
+            settings.LOGIN_IP_BURST,
+            max_keys=settings.LOGIN_THROTTLE_MAX_KEYS,
+        )
+
+    def acquire(self, email: str, client_ip: str | None) -> float:
+        """0 if the attempt may proceed, otherwise seconds to wait"""
+        if not self.enabled:
+            return 0.0
+        if client_ip:
+            retry_after = self.by_ip.acquire(client_ip)
+            if retry_after:
+                return retry_after
+        return self.by_email.acquire(email.lower())
+
+
+login_throttle = LoginThrottle()
@@ -1,78 +1,226 @@
 # region API Routes
+import base64
+import binascii
+import json
 from logging import getLogger
 from uuid import UUID
 
 from fastapi import APIRouter
 from fastapi import Depends
+from fastapi import Header
 from fastapi import HTTPException
-from sqlalchemy.exc import IntegrityError
+from fastapi import Query
+from fastapi import Request
+from fastapi.responses import Response
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
 from sqlalchemy.ext.asyncio import AsyncSession
 from starlette import status
 
+import settings
+from api.actions.auth import get_current_user_for_write
 from api.actions.auth import get_current_user_from_token
 from api.actions.user import _create_new_user
+from api.actions.user import _create_users_bulk
 from api.actions.user import _delete_user
 from api.actions.user import _get_user_by_id
+from api.actions.user import _get_user_version
+from api.actions.user import _get_users_by_ids
+from api.actions.user import _grant_admin_privilege
+from api.actions.user import _list_users
+from api.actions.user import _revoke_admin_privilege
+from api.actions.user import _search_users
+from api.actions.user import _stream_users_ndjson
 from api.actions.user import _update_user
-from api.actions.user import check_user_permissions
+from api.etags import etag_matches
+from api.etags import user_etag
+from api.etags import version_from_if_match
+from api.schemas import BulkCreateStatus
 from api.schemas import UpdateUserRequest
+from api.schemas import UserBatchRequest
+from api.schemas import UserBatchShow
+from api.schemas import UserBulkCreateResult
+from api.schemas import UserBulkCreateRow
 from api.schemas import UserCreate
+from api.schemas import UserPage
+from api.schemas import UserSearchPage
 from api.schemas import UserShow
 from api.schemas import UserShowSecure
+from api.serializers import FastJSONResponse
+from api.serializers import serialize_user_show
+from api.serializers import serialize_user_show_secure
+from db.dals import CreateStatus
+from db.dals import MutationResult
+from db.dals import MutationStatus
+from db.models import PortalRole
 from db.models import User
+from db.session import get_async_read_session
 from db.session import get_async_session
+from db.session import pin_reads_to_primary
 
 logger = getLogger(__name__)
 
 user_router = APIRouter()
 
 
-@user_router.post("/")
+@user_router.post("/", dependencies=[Depends(pin_reads_to_primary)])
 async def create_user(
     body: UserCreate, session: AsyncSession = Depends(get_async_session)
 ) -> UserShow:
-    user = await _create_new_user(body, session)
-    if user:
-        return user
-    else:
+    result = await _create_new_user(body, session)
+    if result.status is CreateStatus.CONFLICT:
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT,
             detail=f"User with email {body.email} already exists.",
         )
+    return FastJSONResponse(serialize_user_show(result.user))
 
 
-@user_router.delete("/")
-async def delete_user(
-    user_id: UUID,
+async def _read_bulk_rows(request: Request) -> list:
+    """JSON array body or, for application/x-ndjson, one JSON object per line"""
+    try:
+        if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+            rows, buffer = [], b""
+            async for chunk in request.stream():
+                *lines, buffer = (buffer + chunk).split(b"\n")
+                rows.extend(json.loads(line) for line in lines if line.strip())
+            if buffer.strip():
+                rows.append(json.loads(buffer))
+        else:
+            rows = await request.json()
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Body must be a JSON array or NDJSON.",
+        )
+    if not isinstance(rows, list):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Body must be a JSON array or NDJSON.",
+        )
+    if len(rows) > settings.USER_BULK_MAX_ROWS:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"At most {settings.USER_BULK_MAX_ROWS} users per request.",
+        )
+    return rows
+
+
+@user_router.post("/bulk", dependencies=[Depends(pin_reads_to_primary)])
+async def create_users_bulk(
+    request: Request,
     session: AsyncSession = Depends(get_async_session),
-    current_user: User = Depends(get_current_user_from_token),
-) -> UserShow:
-    user_for_deletion = await _get_user_by_id(user_id, session)
-    if not user_for_deletion:
+    current_user: User = Depends(get_current_user_for_write),
+) -> UserBulkCreateResult:
+    if not (current_user.is_admin or current_user.is_superadmin):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden.")
+    rows, bodies = [], []
+    for index, raw in enumerate(await _read_bulk_rows(request)):
+        try:
+            body = UserCreate.parse_obj(raw)
+        except ValidationError as err:
+            email = raw.get("email") if isinstance(raw, dict) else None
+            detail = "; ".join(error["msg"] for error in err.errors())
+            rows.append(
+                UserBulkCreateRow(
+                    index=index,
+                    email=email,
+                    status=BulkCreateStatus.INVALID,
+                    detail=detail,
+                )
+            )
+            continue
+        bodies.append((index, body))
+    statuses = await _create_users_bulk([body for _, body in bodies], session)
+    seen = set()
+    for index, body in bodies:
+        if body.email in seen:
+            row = UserBulkCreateRow(
+                index=index,
+                email=body.email,
+                status=BulkCreateStatus.CONFLICT,
+                detail="Duplicate email in request.",
+            )
+        else:
+            row = UserBulkCreateRow(
+                index=index, email=body.email, status=statuses[body.email]
+            )
+        seen.add(body.email)
+        rows.append(row)
+    rows.sort(key=lambda row: row.index)
+    counts = {row_status: 0 for row_status in BulkCreateStatus}
+    for row in rows:
+        counts[row.status] += 1
+    return UserBulkCreateResult(
+        created=counts[BulkCreateStatus.CREATED],
+        reactivated=counts[BulkCreateStatus.REACTIVATED],
+        conflicts=counts[BulkCreateStatus.CONFLICT],
+        invalid=counts[BulkCreateStatus.INVALID],
+        rows=rows,
+    )
+
+
+def _raise_for_failed_mutation(
+    result: MutationResult, user_id: UUID, conflict_detail: str
+) -> None:
+    if result.status is MutationStatus.NOT_FOUND:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"User with id {user_id} not found.",
         )
-    if not check_user_permissions(
-        target_user=user_for_deletion, current_user=current_user
-    ):
+    if result.status is MutationStatus.PROTECTED:
+        raise HTTPException(
+            status_code=406, detail="Superadmin cannot be deleted via API."
+        )
+    if result.status is MutationStatus.FORBIDDEN:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Forbidden.",
         )
-    user = await _delete_user(user_id, session)
-    return user
+    if result.status is MutationStatus.PRECONDITION_FAILED:
+        raise HTTPException(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail=f"User with id {user_id} has been modified.",
+        )
+    if result.status is MutationStatus.CONFLICT:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=conflict_detail,
+        )
+
+
+@user_router.delete("/", dependencies=[Depends(pin_reads_to_primary)])
+async def delete_user(
+    user_id: UUID,
+    session: AsyncSession = Depends(get_async_session),
+    current_user: User = Depends(get_current_user_for_write),
+) -> UserShow:
+    result = await _delete_user(user_id, current_user, session)
+    _raise_for_failed_mutation(result, user_id, conflict_detail="Conflict.")
+    return FastJSONResponse(serialize_user_show(result.user))
+
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
 
 
 @user_router.get("/")
 async def get_user_by_id(
     user_id: UUID,
-    session: AsyncSession = Depends(get_async_session),
+    if_none_match: str | None = Header(default=None),
+    session: AsyncSession = Depends(get_async_read_session),
     current_user: User = Depends(get_current_user_from_token),
 ) -> UserShow:
+    if if_none_match:
+        version = await _get_user_version(user_id, session)
+        if version is not None:
+            etag = user_etag(user_id, version)
+            if etag_matches(if_none_match, etag):
+                return _not_modified(etag)
     user = await _get_user_by_id(user_id, session)
     if user:
-        return user
+        etag = user_etag(user.id, user.version)
+        return FastJSONResponse(serialize_user_show(user), headers={"ETag": etag})
     else:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -80,12 +228,110 @@ async def get_user_by_id(
         )
 
 
-@user_router.patch("/")
+@user_router.post("/batch")
+async def get_users_by_ids(
+    body: UserBatchRequest,
+    session: AsyncSession = Depends(get_async_read_session),
+    current_user: User = Depends(get_current_user_from_token),
+) -> UserBatchShow:
+    user_ids = list(dict.fromkeys(body.ids))
+    users = {user.id: user for user in await _get_users_by_ids(user_ids, session)}
+    return FastJSONResponse(
+        {
+            "users": [
+                serialize_user_show(users[user_id])
+                for user_id in user_ids
+                if user_id in users
+            ],
+            "missing": [str(user_id) for user_id in user_ids if user_id not in users],
+        }
+    )
+
+
+@user_router.get("/list")
+async def list_users(
+    after: UUID | None = None,
+    limit: int = Query(default=100, ge=1, le=1000),
+    is_active: bool | None = None,
+    role: PortalRole | None = None,
+    stream: bool = False,
+    session: AsyncSession = Depends(get_async_read_session),
+    current_user: User = Depends(get_current_user_from_token),
+) -> UserPage:
+    """Keyset-paginated listing ordered by id.
+
+    Pass the returned next_cursor as ``after`` to fetch the following page, or
+    ``stream=true`` to export every matching user as NDJSON.
+    """
+    if not (current_user.is_admin or current_user.is_superadmin):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden.")
+    if stream:
+        return StreamingResponse(
+            _stream_users_ndjson(after, is_active, role, session),
+            media_type="application/x-ndjson",
+        )
+    users = await _list_users(limit, after, is_active, role, session)
+    next_cursor = users[-1].id if len(users) == limit else None
+    return FastJSONResponse(
+        {
+            "users": [serialize_user_show(user) for user in users],
+            "next_cursor": str(next_cursor) if next_cursor else None,
+        }
+    )
+
+
+def _encode_search_cursor(score: float, user_id: UUID) -> str:
+    return base64.urlsafe_b64encode(f"{score!r}:{user_id}".encode()).decode()
+
+
+def _decode_search_cursor(cursor: str) -> tuple[float, UUID]:
+    try:
+        score, _, user_id = base64.urlsafe_b64decode(cursor).decode().partition(":")
+        return float(score), UUID(user_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Invalid cursor."
+        )
+
+
+@user_router.get("/search")
+async def search_users(
+    q: str = Query(min_length=3, max_length=100),
+    limit: int = Query(default=20, ge=1, le=100),
+    cursor: str | None = None,
+    session: AsyncSession = Depends(get_async_read_session),
+    current_user: User = Depends(get_current_user_from_token),
+) -> UserSearchPage:
+    """Active users ranked by trigram similarity of name, surname and email to q.
+
+    Pass the returned next_cursor as ``cursor`` with the same q to fetch the
+    following page.
+    """
+    if not (current_user.is_admin or current_user.is_superadmin):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden.")
+    after = _decode_search_cursor(cursor) if cursor else None
+    hits = await _search_users(q, limit, after, session)
+    next_cursor = None
+    if len(hits) == limit:
+        last_user, last_score = hits[-1]
+        next_cursor = _encode_search_cursor(last_score, last_user.id)
+    return FastJSONResponse(
+        {
+            "users": [
+                {**serialize_user_show(user), "score": score} for user, score in hits
+            ],
+            "next_cursor": next_cursor,
+        }
+    )
+
+
+@user_router.patch("/", dependencies=[Depends(pin_reads_to_primary)])
 async def update_user(
     user_id: UUID,
     body: UpdateUserRequest,
+    if_match: str | None = Header(default=None),
     session: AsyncSession = Depends(get_async_session),
-    current_user: User = Depends(get_current_user_from_token),
+    current_user: User = Depends(get_current_user_for_write),
 ) -> UserShow:
     updated_user_params = body.dict(exclude_none=True)
     if updated_user_params == {}:
@@ -93,89 +339,72 @@ async def update_user(
             status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
             detail="At least one parameter for user update info must provided.",
         )
-    user_for_update = await _get_user_by_id(user_id, session)
-    if not user_for_update:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"User with id {user_id} not found.",
-        )
-    if not check_user_permissions(
-        target_user=user_for_update, current_user=current_user
-    ):
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Forbidden.",
-        )
-    user = await _update_user(user_id, updated_user_params, session)
-    if user:
-        return user
-    else:
-        raise HTTPException(
-            status_code=status.HTTP_409_CONFLICT,
-            detail=f"User with email {body.email} already exists.",
-        )
+    expected_version = None
+    if if_match and if_match.strip() != "*":
+        expected_version = version_from_if_match(if_match, user_id)
+        if expected_version is None:
+            raise HTTPException(
+                status_code=status.HTTP_412_PRECONDITION_FAILED,
+                detail=f"If-Match does not match user with id {user_id}.",
+            )
+    result = await _update_user(
+        user_id, updated_user_params, current_user, session, expected_version
+    )
+    _raise_for_failed_mutation(
+        result,
+        user_id,
+        conflict_detail=f"User with email {body.email} already exists.",
+    )
+    etag = user_etag(result.user.id, result.user.version)
+    return FastJSONResponse(serialize_user_show(result.user), headers={"ETag": etag})
 
 
 @user_router.get("/me")
 async def get_me(
+    if_none_match: str | None = Header(default=None),
     current_user: User = Depends(get_current_user_from_token),
 ) -> UserShowSecure | None:
-    return current_user
+    if current_user.version is None:
+        return FastJSONResponse(serialize_user_show_secure(current_user))
+    etag = user_etag(current_user.id, current_user.version, secure=True)
+    if etag_matches(if_none_match, etag):
+        return _not_modified(etag)
+    return FastJSONResponse(
+        serialize_user_show_secure(current_user), headers={"ETag": etag}
+    )
 
 
-@user_router.patch("/admin_privilege")
+@user_router.patch("/admin_privilege", dependencies=[Depends(pin_reads_to_primary)])
 async def grant_admin_privilege(
     user_id: UUID,
     session: AsyncSession = Depends(get_async_session),
-    current_user: User = Depends(get_current_user_from_token),
+    current_user: User = Depends(get_current_user_for_write),
 ) -> str:
     if not current_user.is_superadmin:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden.")
-    user_for_promotion = await _get_user_by_id(user_id, session)
-    if not user_for_promotion:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"User with id {user_id} not found.",
-        )
-    if user_for_promotion.is_admin | user_for_promotion.is_superadmin:
-        raise HTTPException(
-            status_code=status.HTTP_409_CONFLICT,
-            detail=f"User with id {user_id} already promoted to admin.",
-        )
-    updated_user_params = {"roles": user_for_promotion.add_admin_privilege()}
-    try:
-        await _update_user(user_id, updated_user_params, session)
-    except IntegrityError as err:
-        logger.error(err)
-        raise HTTPException(status_code=503, detail=f"Database error: {err}")
+    result = await _grant_admin_privilege(user_id, session)
+    _raise_for_failed_mutation(
+        result,
+        user_id,
+        conflict_detail=f"User with id {user_id} already promoted to admin.",
+    )
     return f"User {user_id} has been promoted to admin."
 
 
-@user_router.delete("/admin_privilege")
+@user_router.delete("/admin_privilege", dependencies=[Depends(pin_reads_to_primary)])
 async def revoke_admin_privilege(
     user_id: UUID,
     session: AsyncSession = Depends(get_async_session),
-    current_user: User = Depends(get_current_user_from_token),
+    current_user: User = Depends(get_current_user_for_write),
 ) -> str:
     if not current_user.is_superadmin:
         raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Forbidden.")
-    user_for_revoke = await _get_user_by_id(user_id, session)
-    if not user_for_revoke:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"User with id {user_id} not found.",
-        )
-    if not user_for_revoke.is_admin:
-        raise HTTPException(
-            status_code=status.HTTP_409_CONFLICT,
-            detail=f"User with id {user_id} has no admin privileges.",
-        )
-    updated_user_params = {"roles": user_for_revoke.remove_admin_privilege()}
-    try:
-        await _update_user(user_id, updated_user_params, session)
-    except IntegrityError as err:
-        logger.error(err)
-        raise HTTPException(status_code=503, detail=f"Database error: {err}")
+    result = await _revoke_admin_privilege(user_id, session)
+    _raise_for_failed_mutation(
+        result,
+        user_id,
+        conflict_detail=f"User with id {user_id} has no admin privileges.",
+    )
     return f"User {user_id} has no admin privileges."
 
 
@@ -0,0 +1,91 @@
+"""Python overhead per UserDAL query before and after the prebuilt statements.
+
+Times what happens before a statement reaches the driver: building the
+construct, generating its cache key and looking the compiled SQL up in the
+engine's compiled cache. No database is needed.
+
+Run from the repository root: ``python -m benchmarks.dal_statements``
+"""
+import os
+import timeit
+from uuid import uuid4
+
+os.environ.setdefault("DB_URL", "postgresql+asyncpg://localhost/bench")
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
+os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+os.environ.setdefault("ALGORITHM", "HS256")
+
+from sqlalchemy import select
+from sqlalchemy import update
+from sqlalchemy.dialects.postgresql.asyncpg import dialect
+
+from db.dals import _select_user_by_email
+from db.dals import _select_user_by_id
+from db.dals import _update_user_statement
+from db.models import User
+
+NUMBER = 20000
+DIALECT = dialect()
+
+
+def _compile(statement, compiled_cache: dict, column_keys: list[str]):
+    """the lookup Connection.execute does before sending a statement"""
+    return statement._compile_w_cache(
+        dialect=DIALECT, compiled_cache=compiled_cache, column_keys=column_keys
+    )
+
+
+def report(label: str, func) -> None:
+    seconds = min(timeit.repeat(func, number=NUMBER, repeat=3))
+    print(f"{label:<40} {seconds / NUMBER * 1e6:8.2f} us/query")
+
+
+def main():
+    user_id, email = uuid4(), "bench@example.com"
+    cache = {}
+
+    report(
+        "get_user_by_id, built per call",
+        lambda: _compile(
+            select(User).where((User.id == user_id) & (User.is_active == True)),
+            cache,
+            [],
+        ),
+    )
+    report(
+        "get_user_by_id, prebuilt",
+        lambda: _compile(_select_user_by_id, cache, ["user_id"]),
+    )
+    report(
+        "get_user_by_email, built per call",
+        lambda: _compile(
+            select(User).where((User.email == email) & (User.is_active == True)),
+            cache,
+            [],
+        ),
+    )
+    report(
+        "get_user_by_email, prebuilt",
+        lambda: _compile(_select_user_by_email, cache, ["email"]),
+    )
+    report(
+        "update_user, built per call",
+        lambda: _compile(
+            update(User)
+            .where((User.id == user_id) & (User.is_active == True))
+            .values({"name": "Bench", "version": User.version + 1})
+            .returning(User),
+            cache,
+            [],
+        ),
+    )
+    report(
+        "update_user, prebuilt",
+        lambda: _compile(
+            _update_user_statement(("name",)), cache, ["user_id", "set_name"]
+        ),
+    )
+
+
+if __name__ == "__main__":
+    main()
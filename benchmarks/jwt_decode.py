@@ -0,0 +1,50 @@
+"""Per-request token decode cost before and after the verified-token cache.
+
+Run from the repository root: ``python -m benchmarks.jwt_decode``
+"""
+import os
+import timeit
+
+os.environ.setdefault("DB_URL", "postgresql+asyncpg://localhost/bench")
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
+os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+os.environ.setdefault("ALGORITHM", "HS256")
+
+from jose import jwt
+
+import settings
+from security import create_access_token
+from security import decode_access_token
+from security import JWT_BACKENDS
+from security import token_cache
+
+NUMBER = 20000
+
+
+def report(label: str, func) -> None:
+    seconds = min(timeit.repeat(func, number=NUMBER, repeat=3))
+    print(f"{label:<40} {seconds / NUMBER * 1e6:8.2f} us/request")
+
+
+def main():
+    token = create_access_token({"sub": "bench@example.com"})
+
+    report(
+        "jose, raw secret (before)",
+        lambda: jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM]),
+    )
+    for name, backend_class in JWT_BACKENDS.items():
+        try:
+            backend = backend_class(settings.SECRET_KEY, settings.ALGORITHM)
+        except ImportError:
+            print(f"{name + ', prebuilt key':<40} not installed")
+            continue
+        report(f"{name}, prebuilt key", lambda: backend.decode(token))
+
+    token_cache.clear()
+    decode_access_token(token)
+    report("decode_access_token, cached (after)", lambda: decode_access_token(token))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+"""Load and latency benchmark for the user and login API.
+
+Drives the app either in-process through the httpx ASGI transport or over
+HTTP against a running server (``--url``, e.g. a single uvicorn worker in
+front of a local Postgres), runs fixed scenarios and reports p50/p95/p99
+latency, throughput and SQL statements per request:
+
+    python -m benchmarks.load --output results.json
+    python -m benchmarks.load --url http://127.0.0.1:8000 --baseline results.json
+
+The in-process mode still needs DB_URL to point at a migrated database.
+Every request comes from one client IP, so login throttling is switched off
+in-process; start a server under test with LOGIN_THROTTLE_ENABLED=false.
+Against server.py with several workers /metrics sums snapshots the workers
+write every METRICS_FLUSH_SECONDS, so the SQL statement count is read only
+after waiting that long.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import uuid
+from contextlib import asynccontextmanager
+from dataclasses import asdict
+from dataclasses import dataclass
+from typing import AsyncIterator
+
+import httpx
+
+os.environ.setdefault("LOGIN_THROTTLE_ENABLED", "false")
+
+PASSWORD = "bench-password"
+
+
+@dataclass
+class ScenarioResult:
+    name: str
+    requests: int
+    errors: int
+    seconds: float
+    throughput: float
+    p50_ms: float
+    p95_ms: float
+    p99_ms: float
+    db_queries_per_request: float | None
+
+
+@dataclass
+class BenchUser:
+    id: str
+    email: str
+    token: str
+
+
+def _percentile(sorted_values: list[float], percent: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = round(percent / 100 * (len(sorted_values) - 1))
+    return sorted_values[index]
+
+
+async def _db_queries(
+    client: httpx.AsyncClient, settle_seconds: float = 0
+) -> float | None:
+    """total SQL statements the server executed so far, from /metrics"""
+    # until then another worker's snapshot may predate its last requests
+    await asyncio.sleep(settle_seconds)
+    response = await client.get("/metrics")
+    if response.status_code != 200:
+        return None
+    return sum(
+        float(line.rsplit(" ", 1)[1])
+        for line in response.text.splitlines()
+        if line.startswith("db_queries_total")
+    )
+
+
+async def _create_user(client: httpx.AsyncClient, email: str) -> BenchUser:
+    body = {"email": email, "password": PASSWORD}
+    response = await client.post("/user/", json=body)
+    response.raise_for_status()
+    user_id = response.json()["id"]
+    response = await client.post(
+        "/login/token", data={"username": email, "password": PASSWORD}
+    )
+    response.raise_for_status()
+    return BenchUser(id=user_id, email=email, token=response.json()["access_token"])
+
+
+def _auth(user: BenchUser) -> dict:
+    return {"Authorization": f"Bearer {user.token}"}
+
+
+class Scenarios:
+    """Fixed request patterns, every request is timed into samples"""
+
+    def __init__(self, client: httpx.AsyncClient, users: list[BenchUser], seed: int):
+        self.client = client
+        self.users = users
+        self.random = random.Random(seed)
+        self.run_id = uuid.uuid4().hex[:8]
+        self.samples: list[tuple[float, int]] = []
+
+    async def _request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        started = time.perf_counter()
+        response = await self.client.request(method, url, **kwargs)
+        self.samples.append((time.perf_counter() - started, response.status_code))
+        return response
+
+    async def login_storm(self, iteration: int) -> None:
+        user = self.users[iteration % len(self.users)]
+        await self._request(
+            "POST", "/login/token", data={"username": user.email, "password": PASSWORD}
+        )
+
+    async def read_mix(self, iteration: int) -> None:
+        user = self.users[iteration % len(self.users)]
+        kind = iteration % 4
+        if kind == 0:
+            await self._request("GET", "/user/me", headers=_auth(user))
+        elif kind == 3:
+            sample = self.random.sample(self.users, min(20, len(self.users)))
+            ids = [bench_user.id for bench_user in sample]
+            await self._request(
+                "POST", "/user/batch", json={"ids": ids}, headers=_auth(user)
+            )
+        else:
+            other = self.random.choice(self.users)
+            await self._request(
+                "GET", "/user/", params={"user_id": other.id}, headers=_auth(user)
+            )
+
+    async def churn(self, iteration: int) -> None:
+        email = f"churn-{self.run_id}-{iteration}@example.com"
+        created = await self._request(
+            "POST", "/user/", json={"email": email, "password": PASSWORD}
+        )
+        if created.status_code != 200:
+            return
+        login = await self._request(
+            "POST", "/login/token", data={"username": email, "password": PASSWORD}
+        )
+        if login.status_code != 200:
+            return
+        headers = {"Authorization": f"Bearer {login.json()['access_token']}"}
+        params = {"user_id": created.json()["id"]}
+        await self._request(
+            "PATCH", "/user/", params=params, json={"name": "Churned"}, headers=headers
+        )
+        await self._request("DELETE", "/user/", params=params, headers=headers)
+
+
+async def run_scenario(
+    client: httpx.AsyncClient,
+    scenarios: Scenarios,
+    name: str,
+    iterations: int,
+    concurrency: int,
+    settle_seconds: float = 0,
+) -> ScenarioResult:
+    scenario = getattr(scenarios, name)
+    counter = iter(range(iterations))
+
+    async def worker():
+        for iteration in counter:
+            await scenario(iteration)
+
+    scenarios.samples = []
+    queries_before = await _db_queries(client, settle_seconds)
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    seconds = time.perf_counter() - started
+    queries_after = await _db_queries(client, settle_seconds)
+
+    latencies = sorted(latency for latency, _ in scenarios.samples)
+    errors = sum(status_code >= 400 for _, status_code in scenarios.samples)
+    queries_per_request = None
+    if queries_before is not None and queries_after is not None and latencies:
+        queries_per_request = (queries_after - queries_before) / len(latencies)
+    return ScenarioResult(
+        name=name,
+        requests=len(latencies),
+        errors=errors,
+        seconds=seconds,
+        throughput=len(latencies) / seconds if seconds else 0.0,
+        p50_ms=_percentile(latencies, 50) * 1000,
+        p95_ms=_percentile(latencies, 95) * 1000,
+        p99_ms=_percentile(latencies, 99) * 1000,
+        db_queries_per_request=queries_per_request,
+    )
+
+
+@asynccontextmanager
+async def _client(url: str | None) -> AsyncIterator[httpx.AsyncClient]:
+    if url:
+        async with httpx.AsyncClient(base_url=url, timeout=30) as client:
+            yield client
+        return
+    from main import create_app
+
+    app = create_app()
+    # the ASGI transport does not run the lifespan, so warm-up happens here
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench", timeout=30
+        ) as client:
+            yield client
+
+
+def _git_revision() -> str | None:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args) -> dict:
+    async with _client(args.url) as client:
+        run_id = uuid.uuid4().hex[:8]
+        users = [
+            await _create_user(client, f"bench-{run_id}-{index}@example.com")
+            for index in range(args.users)
+        ]
+        scenarios = Scenarios(client, users, seed=args.seed)
+        results = []
+        for name in args.scenarios:
+            result = await run_scenario(
+                client,
+                scenarios,
+                name,
+                iterations=args.iterations,
+                concurrency=args.concurrency,
+                settle_seconds=args.metrics_settle if args.url else 0,
+            )
+            results.append(result)
+            print(_format_result(result))
+    return {
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "target": args.url or "asgi",
+        "parameters": {
+            "users": args.users,
+            "iterations": args.iterations,
+            "concurrency": args.concurrency,
+            "seed": args.seed,
+        },
+        "scenarios": [asdict(result) for result in results],
+    }
+
+
+def _format_result(result: ScenarioResult) -> str:
+    queries = (
+        "-"
+        if result.db_queries_per_request is None
+        else f"{result.db_queries_per_request:.2f}"
+    )
+    return (
+        f"{result.name:<12} {result.requests:>6} req {result.throughput:>8.1f} req/s "
+        f"p50 {result.p50_ms:>7.2f}ms p95 {result.p95_ms:>7.2f}ms "
+        f"p99 {result.p99_ms:>7.2f}ms queries/req {queries} errors {result.errors}"
+    )
+
+
+def compare(current: dict, baseline: dict, max_regression: float) -> bool:
+    """prints the change against baseline, False if a percentile regressed"""
+    ok = True
+    previous = {scenario["name"]: scenario for scenario in baseline["scenarios"]}
+    for scenario in current["scenarios"]:
+        before = previous.get(scenario["name"])
+        if before is None:
+            continue
+        changes = []
+        for key in ("p50_ms", "p95_ms", "p99_ms"):
+            change = 0.0
+            if before[key]:
+                change = (scenario[key] - before[key]) / before[key] * 100
+            ok &= change <= max_regression
+            changes.append(f"{key[:-3]} {change:+.1f}%")
+        print(f"{scenario['name']:<12} vs baseline: {', '.join(changes)}")
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", help="benchmark a running server instead of ASGI")
+    parser.add_argument(
+        "--scenarios",
+        nargs="+",
+        default=["login_storm", "read_mix", "churn"],
+        choices=["login_storm", "read_mix", "churn"],
+    )
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--metrics-settle",
+        type=float,
+        default=1.0,
+        help="seconds to wait before reading /metrics, METRICS_FLUSH_SECONDS "
+        "of the server",
+    )
+    parser.add_argument("--output", help="write results as JSON")
+    parser.add_argument("--baseline", help="JSON results of a previous run")
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=10.0,
+        help="percent a percentile may grow over the baseline",
+    )
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(results, output, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            if not compare(results, json.load(baseline), args.max_regression):
+                sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""Per-response CPU time of the generic FastAPI path and the compiled serializer.
+
+Run from the repository root: ``python -m benchmarks.serialization``
+"""
+import asyncio
+import os
+import time
+import uuid
+
+os.environ.setdefault("DB_URL", "postgresql+asyncpg://localhost/bench")
+os.environ.setdefault("ACCESS_TOKEN_EXPIRE_MINUTES", "30")
+os.environ.setdefault("SECRET_KEY", "benchmark-secret")
+os.environ.setdefault("ALGORITHM", "HS256")
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from api.schemas import UserShow
+from api.serializers import FastJSONResponse
+from api.serializers import serialize_user_show
+from db.models import PortalRole
+from db.models import User
+
+NUMBER = 20000
+
+
+def main():
+    user = User(
+        id=uuid.uuid4(),
+        name="Bench",
+        surname="Mark",
+        email="bench@example.com",
+        password="x",
+        is_active=True,
+        roles=[PortalRole.ROLE_USER, PortalRole.ROLE_ADMIN],
+    )
+    field = create_response_field(name="response", type_=UserShow)
+
+    async def generic():
+        content = await serialize_response(field=field, response_content=user)
+        return JSONResponse(content).body
+
+    async def compiled():
+        return FastJSONResponse(serialize_user_show(user)).body
+
+    async def measure(func) -> float:
+        best = float("inf")
+        for _ in range(3):
+            started = time.perf_counter()
+            for _ in range(NUMBER):
+                await func()
+            best = min(best, time.perf_counter() - started)
+        return best / NUMBER
+
+    paths = (("pydantic + jsonable_encoder", generic), ("compiled", compiled))
+    for label, func in paths:
+        seconds = asyncio.run(measure(func))
+        print(f"{label:<28} {seconds * 1e6:8.2f} us/response")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Signup latency of the single-statement upsert against the previous flow.
+
+The previous flow ran an UPDATE to reactivate, committed, then INSERTed and
+committed again, catching IntegrityError for taken emails. Both are timed
+for new emails, reactivations of deactivated users and active conflicts,
+against the database in DB_URL:
+
+    python -m benchmarks.signup --iterations 500
+
+Password hashing is left out, it is identical for both.
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+
+from db.dals import UserDAL
+from db.models import PortalRole
+from db.models import User
+from db.session import database
+
+PASSWORD = "not-a-real-hash"
+
+
+async def legacy_create_user(session, email: str) -> User | None:
+    statement = (
+        update(User)
+        .where((User.email == email) & (User.is_active == False))
+        .values(is_active=True, version=User.version + 1)
+        .returning(User)
+    )
+    user = (await session.execute(statement)).fetchone()
+    await session.commit()
+    if user:
+        return user[0]
+    session.add(
+        User(
+            name="Bench",
+            surname="Bench",
+            email=email,
+            password=PASSWORD,
+            roles=[PortalRole.ROLE_USER],
+        )
+    )
+    try:
+        await session.commit()
+    except IntegrityError:
+        await session.rollback()
+
+
+async def upsert_create_user(session, email: str) -> None:
+    await UserDAL(session).create_user(
+        name="Bench",
+        surname="Bench",
+        email=email,
+        password=PASSWORD,
+        roles=[PortalRole.ROLE_USER],
+    )
+
+
+async def _prepare(emails: list[str], active: bool) -> None:
+    async with database.session() as session:
+        for email in emails:
+            await upsert_create_user(session, email)
+        if not active:
+            await session.execute(
+                update(User).where(User.email.in_(emails)).values(is_active=False)
+            )
+            await session.commit()
+
+
+async def _time(create, emails: list[str]) -> list[float]:
+    latencies = []
+    for email in emails:
+        async with database.session() as session:
+            started = time.perf_counter()
+            await create(session, email)
+            latencies.append(time.perf_counter() - started)
+    return sorted(latencies)
+
+
+def _report(label: str, latencies: list[float]) -> None:
+    p50 = latencies[len(latencies) // 2] * 1000
+    p95 = latencies[int(len(latencies) * 0.95)] * 1000
+    print(f"{label:<28} p50 {p50:7.2f}ms p95 {p95:7.2f}ms")
+
+
+async def run(iterations: int) -> None:
+    await database.warm(2)
+    strategies = (("before", legacy_create_user), ("after", upsert_create_user))
+    for label, create in strategies:
+        run_id = uuid.uuid4().hex[:8]
+        emails = {
+            case: [f"signup-{run_id}-{case}-{i}@example.com" for i in range(iterations)]
+            for case in ("new", "reactivated", "conflict")
+        }
+        await _prepare(emails["reactivated"], active=False)
+        await _prepare(emails["conflict"], active=True)
+        for case, case_emails in emails.items():
+            _report(f"{case}, {label}", await _time(create, case_emails))
+    await database.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(run(args.iterations))
+
+
+if __name__ == "__main__":
+    main()
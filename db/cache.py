@@ -0,0 +1,237 @@
+"""Read-through cache of active users in front of the UserDAL lookups.
+
+Users are cached by id, emails only point to an id, so a changed email can
+never be served from a stale entry. Lookups that found nothing are cached
+for a shorter time. Writes store the row they returned, or drop it when
+the user is no longer active.
+"""
+import json
+import time
+from collections import OrderedDict
+from logging import getLogger
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from uuid import UUID
+
+import settings
+from db.models import User
+from metrics import registry
+
+logger = getLogger(__name__)
+
+user_cache_requests = registry.counter(
+    "user_cache_requests_total", "User cache lookups by key kind and result."
+)
+
+_NOT_FOUND = "not_found"
+_COLUMNS = [column.key for column in User.__table__.columns]
+
+
+def _to_entry(user: User) -> dict:
+    entry = {column: getattr(user, column) for column in _COLUMNS}
+    entry["id"] = str(user.id)
+    entry["roles"] = list(user.roles)
+    return entry
+
+
+def _from_entry(entry: dict) -> User:
+    return User(**{**entry, "id": UUID(entry["id"]), "roles": list(entry["roles"])})
+
+
+class MemoryBackend:
+    """Bounded in-process LRU whose entries expire after their ttl"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+
+    async def get(self, key: str) -> Any | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        expires_at, value = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return
+        self._entries.move_to_end(key)
+        return value
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def delete(self, keys: list[str]) -> None:
+        for key in keys:
+            self._entries.pop(key, None)
+
+    async def close(self) -> None:
+        self._entries.clear()
+
+
+class RedisBackend:
+    """Cache shared by all workers, requires redis; values are stored as JSON.
+
+    Entries include password hashes, the server must be as trusted as the
+    database.
+    """
+
+    def __init__(self, url: str):
+        import redis.asyncio
+
+        self._client = redis.asyncio.from_url(url)
+
+    async def get(self, key: str) -> Any | None:
+        value = await self._client.get(key)
+        return None if value is None else json.loads(value)
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        await self._client.set(key, json.dumps(value), px=int(ttl * 1000))
+
+    async def delete(self, keys: list[str]) -> None:
+        if keys:
+            await self._client.delete(*keys)
+
+    async def close(self) -> None:
+        await self._client.close()
+
+
+class NullBackend:
+    """caching disabled"""
+
+    async def get(self, key: str) -> Any | None:
+        return None
+
+    async def set(self, key: str, value: Any, ttl: float) -> None:
+        pass
+
+    async def delete(self, keys: list[str]) -> None:
+        pass
+
+    async def close(self) -> None:
+        pass
+
+
+def get_cache_backend(name: str):
+    if name == "memory":
+        if settings.SERVER_WORKER_PROCESSES > 1:
+            # writes would only invalidate the entries of the worker handling them
+            logger.warning(
+                "user cache disabled: the memory backend is per process and "
+                "server.py runs %s workers, use the redis backend",
+                settings.SERVER_WORKER_PROCESSES,
+            )
+            return NullBackend()
+        return MemoryBackend(settings.USER_CACHE_MAX_ENTRIES)
+    if name == "redis":
+        return RedisBackend(settings.USER_CACHE_URL)
+    if name == "none":
+        return NullBackend()
+    raise ValueError(f"Unknown user cache backend: {name}")
+
+
+def _id_key(user_id: UUID | str) -> str:
+    return f"user:id:{user_id}"
+
+
+def _email_key(email: str) -> str:
+    return f"user:email:{email}"
+
+
+class UserCache:
+    """Read-through user cache, the backend is built from settings on first use.
+
+    Callers that may be reading from a lagging replica pass cache_result=False,
+    the replica may not have seen a write that invalidated the entry or a
+    signup, so its results are returned but not cached.
+
+    Any object with the backend methods can be passed in, e.g. a MemoryBackend
+    standing in for the shared one when running locally.
+    """
+
+    def __init__(self, backend=None):
+        self._backend = backend
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = get_cache_backend(settings.USER_CACHE_BACKEND)
+        return self._backend
+
+    async def get_by_id(
+        self,
+        user_id: UUID,
+        load: Callable[[], Awaitable[User | None]],
+        cache_result: bool = True,
+    ) -> User | None:
+        entry = await self.backend.get(_id_key(user_id))
+        if entry == _NOT_FOUND:
+            user_cache_requests.inc(key="id", result="negative_hit")
+            return
+        if entry is not None:
+            user_cache_requests.inc(key="id", result="hit")
+            return _from_entry(entry)
+        user_cache_requests.inc(key="id", result="miss")
+        user = await load()
+        if not cache_result:
+            return user
+        if user is None:
+            await self._set_not_found(_id_key(user_id))
+        else:
+            await self.store(user)
+        return user
+
+    async def get_by_email(
+        self,
+        email: str,
+        load: Callable[[], Awaitable[User | None]],
+        cache_result: bool = True,
+    ) -> User | None:
+        pointer = await self.backend.get(_email_key(email))
+        if pointer == _NOT_FOUND:
+            user_cache_requests.inc(key="email", result="negative_hit")
+            return
+        if pointer is not None:
+            entry = await self.backend.get(_id_key(pointer))
+            if isinstance(entry, dict) and entry["email"] == email:
+                user_cache_requests.inc(key="email", result="hit")
+                return _from_entry(entry)
+        user_cache_requests.inc(key="email", result="miss")
+        user = await load()
+        if not cache_result:
+            return user
+        if user is None:
+            await self._set_not_found(_email_key(email))
+        else:
+            await self.store(user)
+        return user
+
+    async def _set_not_found(self, key: str) -> None:
+        ttl = settings.USER_CACHE_NEGATIVE_TTL_SECONDS
+        await self.backend.set(key, _NOT_FOUND, ttl)
+
+    async def store(self, user: User) -> None:
+        """caches the user as just written, or drops it if it is not active"""
+        if not user.is_active:
+            await self.invalidate(user_ids=[user.id], emails=[user.email])
+            return
+        ttl = settings.USER_CACHE_TTL_SECONDS
+        await self.backend.set(_id_key(user.id), _to_entry(user), ttl)
+        await self.backend.set(_email_key(user.email), str(user.id), ttl)
+
+    async def invalidate(
+        self, user_ids: list[UUID] = (), emails: list[str] = ()
+    ) -> None:
+        keys = [_id_key(user_id) for user_id in user_ids]
+        keys.extend(_email_key(email) for email in emails)
+        await self.backend.delete(keys)
+
+    async def close(self) -> None:
+        if self._backend is not None:
+            await self._backend.close()
+            self._backend = None
+
+
+user_cache = UserCache()
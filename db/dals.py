@@ -1,13 +1,149 @@
 # region Interaction with database in business context
+from dataclasses import dataclass
+from datetime import datetime
+from datetime import timezone
+from enum import Enum
+from typing import AsyncIterator
 from uuid import UUID
+from uuid import uuid4
 
+from sqlalchemy import any_
+from sqlalchemy import ARRAY
+from sqlalchemy import bindparam
+from sqlalchemy import Boolean
+from sqlalchemy import delete
+from sqlalchemy import func
+from sqlalchemy import literal_column
 from sqlalchemy import select
+from sqlalchemy import String
+from sqlalchemy import true
+from sqlalchemy import Update
 from sqlalchemy import update
+from sqlalchemy import Uuid
+from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from db.cache import user_cache
+from db.models import ArchivedUser
 from db.models import PortalRole
 from db.models import User
+from db.models import user_search_text
+from db.session import is_replica_session
+from db.singleflight import SingleFlight
+
+
+class MutationStatus(Enum):
+    OK = "ok"
+    NOT_FOUND = "not_found"
+    FORBIDDEN = "forbidden"
+    PROTECTED = "protected"
+    CONFLICT = "conflict"
+    PRECONDITION_FAILED = "precondition_failed"
+
+
+@dataclass
+class MutationResult:
+    status: MutationStatus
+    user: User | None = None
+
+
+class CreateStatus(Enum):
+    CREATED = "created"
+    REACTIVATED = "reactivated"
+    CONFLICT = "conflict"
+
+
+@dataclass
+class CreateResult:
+    status: CreateStatus
+    user: User | None = None
+
+
+def _manageable_by(actor: User):
+    """target rows the actor may modify or delete"""
+    if actor.is_superadmin:
+        return true()
+    if actor.is_admin:
+        is_admin = User.roles.contains([PortalRole.ROLE_ADMIN.value])
+        return (User.id == actor.id) | ~is_admin
+    return User.id == actor.id
+
+
+def _not_superadmin():
+    return ~User.roles.contains([PortalRole.ROLE_SUPER_ADMIN.value])
+
+
+def _user_from_row(row: dict) -> User:
+    """a User of its own per caller, outside any session"""
+    return User(**{**row, "roles": list(row["roles"])})
+
+
+# Hot statements are built once with bound parameters: SQLAlchemy memoizes the
+# cache key on the construct, so a call only binds values to compiled SQL.
+_active_by_id = (User.id == bindparam("user_id")) & (User.is_active == True)
+# lookups select plain rows, they are shared between coalesced callers
+_select_user_by_id = select(User.__table__).where(_active_by_id)
+_select_user_version = select(User.version).where(_active_by_id)
+_select_token_version = select(User.token_version).where(_active_by_id)
+# revokes the stateless tokens issued before a change of the user
+_revoke_tokens = {"token_version": User.token_version + 1}
+_select_user_by_email = select(User.__table__).where(
+    (User.email == bindparam("email")) & (User.is_active == True)
+)
+# xmax of a row version is only zero when the statement inserted it
+_row_inserted = literal_column("xmax = 0", Boolean).label("inserted")
+_user_lookups = SingleFlight("user_lookup")
+
+_update_user_statements: dict[tuple[str, ...], Update] = {}
+
+# Deactivated users are archived in one statement: the batch is locked with
+# SKIP LOCKED, so rows held by a writer or a concurrent run are left for later.
+_archive_batch = (
+    select(User.id)
+    .where(
+        (User.is_active == False)
+        & (User.deactivated_at < bindparam("deactivated_before"))
+    )
+    .order_by(User.deactivated_at)
+    .limit(bindparam("limit"))
+    .with_for_update(skip_locked=True)
+    .cte("archive_batch")
+)
+_ARCHIVED_COLUMNS = ("id", "name", "surname", "email", "roles", "version")
+_archived_users = (
+    delete(User)
+    .where(User.id.in_(select(_archive_batch.c.id)))
+    .returning(
+        *(getattr(User, column) for column in _ARCHIVED_COLUMNS), User.deactivated_at
+    )
+    .cte("archived_users")
+)
+_archive_users = (
+    insert(ArchivedUser)
+    .from_select(
+        [*_ARCHIVED_COLUMNS, "deactivated_at"],
+        select(
+            *(_archived_users.c[column] for column in _ARCHIVED_COLUMNS),
+            _archived_users.c.deactivated_at,
+        ),
+    )
+    .returning(ArchivedUser.id)
+)
+
+
+def _update_user_statement(columns: tuple[str, ...]) -> Update:
+    """UPDATE of the active user setting columns from set_<column> parameters"""
+    statement = _update_user_statements.get(columns)
+    if statement is None:
+        values = {column: bindparam(f"set_{column}") for column in columns}
+        statement = _update_user_statements[columns] = (
+            update(User)
+            .where(_active_by_id)
+            .values({**values, "version": User.version + 1})
+            .returning(User)
+        )
+    return statement
 
 
 class UserDAL:
@@ -23,66 +159,376 @@ class UserDAL:
         email: str,
         password: str,
         roles: list[PortalRole],
-    ) -> User | None:
+    ) -> CreateResult:
+        """Inserts the user or reactivates a deactivated one with the email.
+
+        One INSERT ... ON CONFLICT DO UPDATE statement; an active user with the
+        email is left alone and reported as a conflict.
+        """
         statement = (
-            update(User)
-            .where((User.email == email) & (User.is_active == False))
-            .values(is_active=True)
-            .returning(User)
+            insert(User)
+            .values(
+                name=name, surname=surname, email=email, password=password, roles=roles
+            )
+            .on_conflict_do_update(
+                index_elements=[User.email],
+                set_={
+                    "is_active": True,
+                    "deactivated_at": None,
+                    "version": User.version + 1,
+                },
+                where=User.is_active == False,
+            )
+            .returning(User, _row_inserted)
         )
-        user = await self.db_session.execute(statement)
+        row = (await self.db_session.execute(statement)).fetchone()
         await self.db_session.commit()
-        user = user.fetchone()
-        if user:
-            return user[0]
+        if row is None:
+            return CreateResult(CreateStatus.CONFLICT)
+        user, inserted = row
+        await user_cache.store(user)
+        status = CreateStatus.CREATED if inserted else CreateStatus.REACTIVATED
+        return CreateResult(status, user)
 
-        else:
-            new_user = User(
-                name=name, surname=surname, email=email, password=password, roles=roles
+    async def get_email_activity(self, emails: list[str]) -> dict[str, bool]:
+        """is_active flag of every existing user among emails"""
+        emails_param = bindparam("emails", emails, type_=ARRAY(String))
+        query = select(User.email, User.is_active).where(
+            User.email == any_(emails_param)
+        )
+        rows = await self.db_session.execute(query)
+        return {email: is_active for email, is_active in rows}
+
+    async def create_users_bulk(
+        self, reactivate: list[str], new_users: list[dict], batch_size: int
+    ) -> tuple[set[str], set[str]]:
+        """Reactivates and inserts users in a single transaction.
+
+        Returns the reactivated and the created emails, anything else was taken
+        by a concurrent writer in the meantime.
+        """
+        reactivated, created = set(), set()
+        reactivated_ids = []
+        try:
+            if reactivate:
+                emails = bindparam("emails", reactivate, type_=ARRAY(String))
+                statement = (
+                    update(User)
+                    .where((User.email == any_(emails)) & (User.is_active == False))
+                    .values(
+                        is_active=True, deactivated_at=None, version=User.version + 1
+                    )
+                    .returning(User.id, User.email)
+                )
+                result = await self.db_session.execute(statement)
+                for user_id, email in result:
+                    reactivated_ids.append(user_id)
+                    reactivated.add(email)
+            statement = (
+                insert(User)
+                .on_conflict_do_nothing(index_elements=[User.email])
+                .returning(User.email)
             )
-            self.db_session.add(new_user)
-            # await self.db_session.flush()
-            try:
-                await self.db_session.commit()
-                return new_user
-            except IntegrityError:
-                """if email is occupied"""
-                return
+            for start in range(0, len(new_users), batch_size):
+                batch = new_users[start : start + batch_size]
+                result = await self.db_session.execute(statement, batch)
+                created.update(result.scalars())
+            await self.db_session.commit()
+        except Exception:
+            await self.db_session.rollback()
+            raise
+        # drops cached not-found results of the emails and reactivated ids
+        await user_cache.invalidate(
+            user_ids=reactivated_ids, emails=[*reactivated, *created]
+        )
+        return reactivated, created
 
     async def delete_user(self, user_id: UUID) -> User | None:
-        return await self.update_user(user_id, is_active=False)
+        return await self.update_user(
+            user_id, is_active=False, deactivated_at=datetime.now(timezone.utc)
+        )
+
+    async def archive_inactive_users(
+        self, deactivated_before: datetime, limit: int
+    ) -> int:
+        """Moves up to limit users deactivated before the cutoff to users_archive.
+
+        Commits and returns how many users were moved. The user cache needs no
+        invalidation, it never holds deactivated users.
+        """
+        result = await self.db_session.execute(
+            _archive_users, {"deactivated_before": deactivated_before, "limit": limit}
+        )
+        archived = len(result.all())
+        await self.db_session.commit()
+        return archived
 
     async def get_user_by_id(self, user_id: UUID) -> User | None:
-        query = select(User).where((User.id == user_id) & (User.is_active == True))
-        user = await self.db_session.execute(query)
+        """Served from the user cache when possible.
+
+        Concurrent misses for the id against the same database share a query.
+        """
+        key = (self.db_session.bind, "id", user_id)
+        return await user_cache.get_by_id(
+            user_id,
+            lambda: self._coalesced(key, self._get_user_by_id, user_id),
+            cache_result=not is_replica_session(self.db_session),
+        )
+
+    @staticmethod
+    async def _coalesced(key, lookup, *args) -> User | None:
+        """Runs lookup once for concurrent calls with the same key.
+
+        The row is shared, every caller gets its own User built from it, so
+        no session's identity map or expiry affects another caller.
+        """
+        row = await _user_lookups.do(key, lookup, *args)
+        return None if row is None else _user_from_row(row)
+
+    async def _get_user_by_id(self, user_id: UUID) -> dict | None:
+        user = await self.db_session.execute(_select_user_by_id, {"user_id": user_id})
         # await self.db_session.commit()
-        user = user.fetchone()
+        user = user.mappings().first()
         if user:
-            return user[0]
+            return dict(user)
+
+    async def get_user_version(self, user_id: UUID) -> int | None:
+        """version of the active user without loading the row"""
+        version = await self.db_session.execute(
+            _select_user_version, {"user_id": user_id}
+        )
+        return version.scalar()
+
+    async def get_token_version(self, user_id: UUID) -> int | None:
+        """token version of the active user, None once deactivated"""
+        version = await self.db_session.execute(
+            _select_token_version, {"user_id": user_id}
+        )
+        return version.scalar()
+
+    async def warm(self, read_only: bool) -> None:
+        """runs the hot statements once so they are compiled and prepared"""
+        missing_id = uuid4()
+        await self._get_user_by_id(missing_id)
+        await self._get_user_by_email(f"{missing_id.hex}@example.com")
+        await self.get_user_version(missing_id)
+        await self.get_token_version(missing_id)
+        if not read_only:
+            await self.delete_user(missing_id)
+            await self.update_user(missing_id, password="")
+
+    async def get_users_by_ids(self, user_ids: list[UUID]) -> list[User]:
+        """active users among user_ids in one round trip, missing ids are skipped"""
+        ids = bindparam("ids", user_ids, type_=ARRAY(Uuid))
+        query = select(User).where((User.id == any_(ids)) & (User.is_active == True))
+        users = await self.db_session.execute(query)
+        return list(users.scalars())
+
+    @staticmethod
+    def _list_users_query(
+        after: UUID | None, is_active: bool | None, role: PortalRole | None
+    ):
+        query = select(User).order_by(User.id)
+        if after is not None:
+            query = query.where(User.id > after)
+        if is_active is not None:
+            query = query.where(User.is_active == is_active)
+        if role is not None:
+            query = query.where(User.roles.contains([role.value]))
+        return query
+
+    async def list_users(
+        self,
+        limit: int,
+        after: UUID | None = None,
+        is_active: bool | None = None,
+        role: PortalRole | None = None,
+    ) -> list[User]:
+        """one keyset page of users ordered by id, starting after the cursor"""
+        query = self._list_users_query(after, is_active, role).limit(limit)
+        users = await self.db_session.execute(query)
+        return list(users.scalars())
+
+    async def stream_users(
+        self,
+        chunk_size: int,
+        after: UUID | None = None,
+        is_active: bool | None = None,
+        role: PortalRole | None = None,
+    ) -> AsyncIterator[User]:
+        """all matching users through a server-side cursor"""
+        query = self._list_users_query(after, is_active, role)
+        users = await self.db_session.stream_scalars(
+            query.execution_options(yield_per=chunk_size)
+        )
+        async for user in users:
+            yield user
+
+    async def search_users(
+        self, query: str, limit: int, after: tuple[float, UUID] | None = None
+    ) -> list[tuple[User, float]]:
+        """Active users whose name, surname or email resembles query.
+
+        Matches are word-similar to query or contain it, both served by the
+        trigram index, and come with their similarity, best first. after is
+        the (similarity, id) of the last user of the previous page.
+        """
+        # backslash is the default LIKE escape character
+        escaped = query.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        search_text = user_search_text.self_group()
+        score = func.word_similarity(query, search_text)
+        statement = (
+            select(User, score)
+            .where(
+                (User.is_active == True)
+                & (search_text.op("%>")(query) | search_text.ilike(f"%{escaped}%"))
+            )
+            .order_by(score.desc(), User.id)
+            .limit(limit)
+        )
+        if after is not None:
+            after_score, after_id = after
+            statement = statement.where(
+                (score < after_score) | ((score == after_score) & (User.id > after_id))
+            )
+        rows = await self.db_session.execute(statement)
+        return [(user, score) for user, score in rows]
+
+    async def get_user_by_email(self, email: str, cached: bool = True) -> User | None:
+        """Served from the user cache when possible and cached.
+
+        Concurrent misses for the email against the same database share a query.
+        """
+        key = (self.db_session.bind, "email", email)
+        if not cached:
+            return await self._coalesced(key, self._get_user_by_email, email)
+        return await user_cache.get_by_email(
+            email,
+            lambda: self._coalesced(key, self._get_user_by_email, email),
+            cache_result=not is_replica_session(self.db_session),
+        )
 
-    async def get_user_by_email(self, email: str) -> User | None:
-        query = select(User).where((User.email == email) & (User.is_active == True))
-        user = await self.db_session.execute(query)
+    async def _get_user_by_email(self, email: str) -> dict | None:
+        user = await self.db_session.execute(_select_user_by_email, {"email": email})
         # await self.db_session.commit()
+        user = user.mappings().first()
+        if user:
+            return dict(user)
+
+    async def update_user(self, user_id: UUID, **kwargs) -> User | bool | None:
+        statement = _update_user_statement(tuple(sorted(kwargs)))
+        parameters = {f"set_{column}": value for column, value in kwargs.items()}
+        try:
+            user = await self.db_session.execute(
+                statement, {"user_id": user_id, **parameters}
+            )
+        except IntegrityError:
+            return False
+        await self.db_session.commit()
         user = user.fetchone()
         if user:
+            await user_cache.store(user[0])
             return user[0]
 
-    async def update_user(self, user_id: UUID, **kwargs) -> User | bool | None:
+    async def _conditional_update(
+        self,
+        user_id: UUID,
+        predicate,
+        values: dict,
+        diagnose,
+        expected_version: int | None = None,
+    ) -> MutationResult:
+        """Single UPDATE ... WHERE predicate RETURNING for the active user.
+
+        The row is read back only when nothing was updated, to tell not-found,
+        a failed predicate (reported as diagnose(roles)) and a stale
+        expected_version apart.
+        """
+        condition = (User.id == user_id) & (User.is_active == True)
+        if expected_version is not None:
+            condition &= User.version == expected_version
         statement = (
             update(User)
-            .where((User.id == user_id) & (User.is_active == True))
-            .values(kwargs)
+            .where(condition & predicate)
+            .values({**values, "version": User.version + 1})
             .returning(User)
         )
         try:
             user = await self.db_session.execute(statement)
         except IntegrityError:
-            return False
-        await self.db_session.commit()
+            await self.db_session.rollback()
+            return MutationResult(MutationStatus.CONFLICT)
         user = user.fetchone()
+        await self.db_session.commit()
         if user:
-            return user[0]
+            await user_cache.store(user[0])
+            return MutationResult(MutationStatus.OK, user[0])
+        query = select(User.roles, User.version, predicate).where(
+            (User.id == user_id) & (User.is_active == True)
+        )
+        row = (await self.db_session.execute(query)).fetchone()
+        if row is None:
+            return MutationResult(MutationStatus.NOT_FOUND)
+        roles, version, allowed = row
+        if not allowed:
+            return MutationResult(diagnose(roles))
+        if expected_version is not None and version != expected_version:
+            return MutationResult(MutationStatus.PRECONDITION_FAILED)
+        # changed by a concurrent writer between the two statements
+        return MutationResult(MutationStatus.CONFLICT)
+
+    @staticmethod
+    def _diagnose_management(roles: list[str]) -> MutationStatus:
+        if PortalRole.ROLE_SUPER_ADMIN in roles:
+            return MutationStatus.PROTECTED
+        return MutationStatus.FORBIDDEN
+
+    async def delete_user_as(self, user_id: UUID, actor: User) -> MutationResult:
+        return await self._conditional_update(
+            user_id,
+            _manageable_by(actor) & _not_superadmin(),
+            {"is_active": False, "deactivated_at": func.now(), **_revoke_tokens},
+            self._diagnose_management,
+        )
+
+    async def update_user_as(
+        self,
+        user_id: UUID,
+        actor: User,
+        expected_version: int | None = None,
+        **kwargs,
+    ) -> MutationResult:
+        return await self._conditional_update(
+            user_id,
+            _manageable_by(actor) & _not_superadmin(),
+            {**kwargs, **_revoke_tokens},
+            self._diagnose_management,
+            expected_version=expected_version,
+        )
+
+    async def grant_admin_privilege(self, user_id: UUID) -> MutationResult:
+        return await self._conditional_update(
+            user_id,
+            ~User.roles.overlap(
+                [PortalRole.ROLE_ADMIN.value, PortalRole.ROLE_SUPER_ADMIN.value]
+            ),
+            {
+                "roles": func.array_append(User.roles, PortalRole.ROLE_ADMIN.value),
+                **_revoke_tokens,
+            },
+            lambda roles: MutationStatus.CONFLICT,
+        )
+
+    async def revoke_admin_privilege(self, user_id: UUID) -> MutationResult:
+        return await self._conditional_update(
+            user_id,
+            User.roles.contains([PortalRole.ROLE_ADMIN.value]),
+            {
+                "roles": func.array_remove(User.roles, PortalRole.ROLE_ADMIN.value),
+                **_revoke_tokens,
+            },
+            lambda roles: MutationStatus.CONFLICT,
+        )
 
 
 # endregion
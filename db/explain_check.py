@@ -0,0 +1,122 @@
+"""Checks that every UserDAL query is served by an index.
+
+Runs the DAL methods inside a transaction that is rolled back at the end,
+captures the SQL they send and EXPLAINs it with the same parameters.
+Sequential scans are disabled for the check by default, because on a small
+table the planner prefers them even when a usable index exists.
+
+    python -m db.explain_check [--allow-seqscan]
+"""
+import argparse
+import asyncio
+import json
+import sys
+from datetime import datetime
+from datetime import timezone
+from uuid import uuid4
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from db.dals import UserDAL
+from db.models import PortalRole
+from db.session import database
+
+INDEX_NODES = {
+    "Index Scan",
+    "Index Only Scan",
+    "Bitmap Index Scan",
+    "Bitmap Heap Scan",
+}
+DML = ("SELECT", "UPDATE", "INSERT", "DELETE", "WITH")
+
+
+def _walk(plan: dict):
+    yield plan
+    for child in plan.get("Plans", ()):
+        yield from _walk(child)
+
+
+def _scans(plan: dict) -> list[tuple[str, str | None]]:
+    """table and index scans, a CTE or subquery scan reads rows of another node"""
+    return [
+        (node["Node Type"], node.get("Index Name"))
+        for node in _walk(plan)
+        if node["Node Type"].endswith("Scan")
+        and ("Relation Name" in node or "Index Name" in node)
+    ]
+
+
+def _checks(user_dal: UserDAL):
+    missing_id, missing_email = uuid4(), f"{uuid4().hex}@example.com"
+    return {
+        "get_user_by_id": lambda: user_dal.get_user_by_id(missing_id),
+        "get_user_by_email": lambda: user_dal.get_user_by_email(missing_email),
+        "get_users_by_ids": lambda: user_dal.get_users_by_ids([missing_id]),
+        "get_email_activity": lambda: user_dal.get_email_activity([missing_email]),
+        "list_users(role)": lambda: user_dal.list_users(
+            limit=10, role=PortalRole.ROLE_ADMIN
+        ),
+        "search_users": lambda: user_dal.search_users("explain", limit=10),
+        "update_user": lambda: user_dal.update_user(missing_id, name="explain"),
+        "archive_users": lambda: user_dal.archive_inactive_users(
+            datetime.now(timezone.utc), limit=10
+        ),
+    }
+
+
+async def explain_user_queries(allow_seqscan: bool = False) -> bool:
+    captured: list[tuple[str, tuple]] = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith(DML):
+            captured.append((statement, parameters))
+
+    ok = True
+    engine = database.engine
+    async with engine.connect() as connection:
+        transaction = await connection.begin()
+        if not allow_seqscan:
+            await connection.exec_driver_sql("SET LOCAL enable_seqscan = off")
+        session = AsyncSession(
+            bind=connection, join_transaction_mode="create_savepoint"
+        )
+        sync_engine = engine.sync_engine
+        event.listen(sync_engine, "before_cursor_execute", capture)
+        try:
+            for name, run in _checks(UserDAL(session)).items():
+                captured.clear()
+                await run()
+                for statement, parameters in list(captured):
+                    result = await connection.exec_driver_sql(
+                        f"EXPLAIN (FORMAT JSON) {statement}", parameters
+                    )
+                    plan = result.scalar()
+                    if isinstance(plan, str):
+                        plan = json.loads(plan)
+                    scans = _scans(plan[0]["Plan"])
+                    indexed = all(node in INDEX_NODES for node, _ in scans)
+                    ok &= indexed
+                    used = ", ".join(f"{node} ({index})" for node, index in scans)
+                    print(f"{'ok  ' if indexed else 'FAIL'} {name:<20} {used}")
+        finally:
+            event.remove(sync_engine, "before_cursor_execute", capture)
+            await session.close()
+            await transaction.rollback()
+    await database.dispose()
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--allow-seqscan",
+        action="store_true",
+        help="keep sequential scans enabled, use on production-sized data",
+    )
+    args = parser.parse_args()
+    sys.exit(0 if asyncio.run(explain_user_queries(args.allow_seqscan)) else 1)
+
+
+if __name__ == "__main__":
+    main()
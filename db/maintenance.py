@@ -0,0 +1,135 @@
+"""Moves users deactivated longer than the retention window to users_archive.
+
+Works in small transactions with a pause between them, so that it never
+holds many row locks or competes with the app for long. Rows locked by a
+writer are skipped and picked up by a later run, which also keeps app
+workers running the job on their own schedule out of each other's way.
+
+    python -m db.maintenance [--retention-days 30] [--batch-size 500]
+"""
+import argparse
+import asyncio
+import random
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from datetime import timedelta
+from datetime import timezone
+from logging import getLogger
+
+import settings
+from db.dals import UserDAL
+from db.session import database
+from logs import configure_logging
+from logs import shutdown_logging
+from metrics import registry
+
+logger = getLogger(__name__)
+
+users_archived = registry.counter(
+    "users_archived_total", "Deactivated users moved to the archive table."
+)
+archive_batch_duration = registry.histogram(
+    "user_archive_batch_seconds", "Time to move one batch of users to the archive."
+)
+
+
+@dataclass
+class ArchiveReport:
+    rows: int = 0
+    batches: int = 0
+    seconds: float = 0.0
+
+
+async def archive_inactive_users(
+    retention: timedelta,
+    batch_size: int,
+    pause: float,
+    max_batches: int | None = None,
+) -> ArchiveReport:
+    """archives batches until one comes back short or max_batches ran"""
+    deactivated_before = datetime.now(timezone.utc) - retention
+    report = ArchiveReport()
+    started = time.perf_counter()
+    while max_batches is None or report.batches < max_batches:
+        batch_started = time.perf_counter()
+        async with database.session() as session:
+            moved = await UserDAL(session).archive_inactive_users(
+                deactivated_before, batch_size
+            )
+        elapsed = time.perf_counter() - batch_started
+        archive_batch_duration.observe(elapsed)
+        users_archived.inc(moved)
+        report.rows += moved
+        report.batches += 1
+        logger.info("archived %s users in %.3fs", moved, elapsed)
+        if moved < batch_size:
+            break
+        await asyncio.sleep(pause)
+    report.seconds = time.perf_counter() - started
+    logger.info(
+        "archived %s users in %s batches, %.3fs",
+        report.rows,
+        report.batches,
+        report.seconds,
+    )
+    return report
+
+
+async def run_archive_schedule(interval: float) -> None:
+    """Archives every interval seconds until cancelled, used by the app lifespan.
+
+    The first run is delayed by a random part of the interval, so that
+    workers started together do not run together.
+    """
+    await asyncio.sleep(random.uniform(0, interval))
+    while True:
+        try:
+            await archive_inactive_users(
+                timedelta(days=settings.USER_RETENTION_DAYS),
+                settings.ARCHIVE_BATCH_SIZE,
+                settings.ARCHIVE_BATCH_PAUSE_SECONDS,
+            )
+        except Exception:
+            # e.g. an unreachable database or an exhausted pool, retried next time
+            logger.warning("archiving inactive users failed", exc_info=True)
+        await asyncio.sleep(interval)
+
+
+async def _main(args: argparse.Namespace) -> None:
+    configure_logging()
+    try:
+        report = await archive_inactive_users(
+            timedelta(days=args.retention_days),
+            args.batch_size,
+            args.pause,
+            max_batches=args.max_batches,
+        )
+    finally:
+        await database.dispose()
+        shutdown_logging()
+    per_batch = report.seconds / report.batches if report.batches else 0.0
+    print(
+        f"moved {report.rows} users in {report.batches} batches, "
+        f"{report.seconds:.3f}s, {per_batch * 1000:.1f}ms per batch"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--retention-days", type=float, default=settings.USER_RETENTION_DAYS
+    )
+    parser.add_argument("--batch-size", type=int, default=settings.ARCHIVE_BATCH_SIZE)
+    parser.add_argument(
+        "--pause",
+        type=float,
+        default=settings.ARCHIVE_BATCH_PAUSE_SECONDS,
+        help="seconds to wait between batches",
+    )
+    parser.add_argument("--max-batches", type=int, help="stop after this many")
+    asyncio.run(_main(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,16 @@
 # region Database models
+from datetime import datetime
 from enum import Enum
 from uuid import UUID
 from uuid import uuid4
 
-from sqlalchemy import ARRAY
 from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import Index
+from sqlalchemy import literal_column
 from sqlalchemy import String
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import ARRAY
 from sqlalchemy.orm import DeclarativeBase
 from sqlalchemy.orm import Mapped
 from sqlalchemy.orm import mapped_column
@@ -23,6 +28,14 @@ class PortalRole(str, Enum):
 
 class User(Base):
     __tablename__ = "users"
+    __table_args__ = (
+        Index("ix_users_roles", "roles", postgresql_using="gin"),
+        Index(
+            "ix_users_deactivated_at",
+            "deactivated_at",
+            postgresql_where=text("NOT is_active"),
+        ),
+    )
 
     id: Mapped[UUID] = mapped_column(primary_key=True, default=uuid4, unique=True)
     name: Mapped[str] = mapped_column(nullable=False)
@@ -31,6 +44,12 @@ class User(Base):
     password: Mapped[str] = mapped_column(nullable=False)
     is_active: Mapped[bool] = mapped_column(default=True)
     roles: list[str] = Column(ARRAY(String), nullable=False)
+    # bumped on every change, used as the ETag of user representations
+    version: Mapped[int] = mapped_column(default=1, server_default=text("1"))
+    # bumped when issued stateless tokens must stop being accepted
+    token_version: Mapped[int] = mapped_column(default=0, server_default=text("0"))
+    # set while the user is deactivated, archived after the retention window
+    deactivated_at: Mapped[datetime | None] = mapped_column(DateTime(timezone=True))
 
     @property
     def is_admin(self) -> bool:
@@ -47,4 +66,40 @@ class User(Base):
         return {role for role in self.roles if role != PortalRole.ROLE_ADMIN}
 
 
+class ArchivedUser(Base):
+    """Deactivated users moved out of users by db.maintenance, without password"""
+
+    __tablename__ = "users_archive"
+
+    id: Mapped[UUID] = mapped_column(primary_key=True)
+    name: Mapped[str] = mapped_column(nullable=False)
+    surname: Mapped[str] = mapped_column(nullable=False)
+    email: Mapped[str] = mapped_column(nullable=False, index=True)
+    roles: list[str] = Column(ARRAY(String), nullable=False)
+    version: Mapped[int] = mapped_column(nullable=False)
+    deactivated_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False
+    )
+    archived_at: Mapped[datetime] = mapped_column(
+        DateTime(timezone=True), nullable=False, server_default=text("now()")
+    )
+
+
+# name, surname and email as one text, trigram indexed for the user search
+user_search_text = (
+    User.name
+    + literal_column("' '")
+    + User.surname
+    + literal_column("' '")
+    + User.email
+)
+Index(
+    "ix_users_search_trgm",
+    user_search_text.label("search_text"),
+    postgresql_using="gin",
+    postgresql_ops={"search_text": "gin_trgm_ops"},
+    postgresql_where=text("is_active"),
+)
+
+
 # endregion
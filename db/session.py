@@ -1,20 +1,308 @@
 # region Common interaction with database
+import asyncio
+import hashlib
+import hmac
+import itertools
+import time
+from http.cookies import SimpleCookie
+from logging import getLogger
+from typing import Awaitable
+from typing import Callable
 from typing import Generator
 
+from fastapi import Depends
+from fastapi import Request
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.ext.asyncio import AsyncConnection
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import create_async_engine
 
 import settings
+from metrics import forget_engine
+from metrics import instrument_engine
+from metrics import TimedAsyncAdaptedQueuePool
 
-engine = create_async_engine(settings.DB_URL, future=True, echo=True)
+logger = getLogger(__name__)
 
-async_session = async_sessionmaker(engine, expire_on_commit=False)
+
+def _checked_out(replica: AsyncEngine) -> int:
+    return replica.sync_engine.pool.checkedout()
+
+
+class ReplicaPool:
+    """Read replica engines, replicas that fail to connect are ejected for a while"""
+
+    def __init__(
+        self,
+        urls: list[str],
+        strategy: str,
+        retry_seconds: int,
+        connect_args: dict | None = None,
+    ):
+        if strategy not in ("round_robin", "least_connections"):
+            raise ValueError(f"Unknown replica strategy: {strategy}")
+        self.strategy = strategy
+        self.retry_seconds = retry_seconds
+        self.engines = [
+            create_async_engine(
+                url,
+                future=True,
+                pool_pre_ping=True,
+                poolclass=TimedAsyncAdaptedQueuePool,
+                pool_size=settings.DB_POOL_SIZE,
+                max_overflow=settings.DB_MAX_OVERFLOW,
+                connect_args=connect_args or {},
+            )
+            for url in urls
+        ]
+        for replica in self.engines:
+            instrument_engine(replica, role="replica")
+        self._ejected_until = {replica: 0.0 for replica in self.engines}
+        self._turn = itertools.count()
+
+    def choose(self) -> AsyncEngine | None:
+        now = time.monotonic()
+        healthy = [
+            replica
+            for replica, ejected_until in self._ejected_until.items()
+            if ejected_until <= now
+        ]
+        if not healthy:
+            return
+        if self.strategy == "least_connections":
+            return min(healthy, key=_checked_out)
+        return healthy[next(self._turn) % len(healthy)]
+
+    def eject(self, replica: AsyncEngine) -> None:
+        self._ejected_until[replica] = time.monotonic() + self.retry_seconds
+
+
+class PrimaryPins:
+    """Signed cookies keeping the reads of a client that just wrote on the primary.
+
+    The cookie holds the time the pin expires, so it is honoured by whichever
+    server worker handles the next read. The signature keeps clients from
+    pinning themselves for longer.
+    """
+
+    cookie = "primary_pin"
+
+    def __init__(self, seconds: int, secret_key: str):
+        self.seconds = seconds
+        self._key = secret_key.encode()
+
+    def _sign(self, until: str) -> str:
+        return hmac.new(self._key, until.encode(), hashlib.sha256).hexdigest()
+
+    def cookie_header(self) -> bytes:
+        until = str(int(time.time()) + self.seconds)
+        cookie = SimpleCookie()
+        cookie[self.cookie] = f"{until}.{self._sign(until)}"
+        cookie[self.cookie]["max-age"] = self.seconds
+        cookie[self.cookie]["path"] = "/"
+        cookie[self.cookie]["httponly"] = True
+        cookie[self.cookie]["samesite"] = "lax"
+        return cookie.output(header="").strip().encode("latin-1")
+
+    def is_pinned(self, value: str | None) -> bool:
+        if not value:
+            return False
+        until, _, signature = value.partition(".")
+        if not hmac.compare_digest(signature, self._sign(until)):
+            return False
+        return until.isdigit() and int(until) > time.time()
+
+
+async def _warm_engine(
+    engine: AsyncEngine,
+    connections: int,
+    prepare: Callable[[AsyncSession, bool], Awaitable] | None,
+    read_only: bool,
+) -> None:
+    connections = min(connections, engine.sync_engine.pool.size())
+    opened = await asyncio.gather(
+        *(engine.connect().start() for _ in range(connections)),
+        return_exceptions=True,
+    )
+    try:
+        for connection in opened:
+            if isinstance(connection, BaseException):
+                raise connection
+            if prepare is None:
+                continue
+            transaction = await connection.begin()
+            session = AsyncSession(
+                bind=connection, join_transaction_mode="create_savepoint"
+            )
+            try:
+                await prepare(session, read_only)
+            finally:
+                await session.close()
+                await transaction.rollback()
+    finally:
+        await asyncio.gather(
+            *(
+                connection.close()
+                for connection in opened
+                if isinstance(connection, AsyncConnection)
+            )
+        )
+
+
+class Database:
+    """Primary engine, read replicas and primary pins built from settings.
+
+    Everything is created on first use, so importing this module neither
+    needs the environment nor connects. The app lifespan connects and warms
+    the pools up front and disposes them on shutdown.
+    """
+
+    def __init__(self):
+        self._engine: AsyncEngine | None = None
+
+    def connect(self) -> None:
+        if self._engine is not None:
+            return
+        connect_args = {
+            "prepared_statement_cache_size": settings.DB_PREPARED_STATEMENT_CACHE_SIZE
+        }
+        engine = create_async_engine(
+            settings.DB_URL,
+            future=True,
+            poolclass=TimedAsyncAdaptedQueuePool,
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            connect_args=connect_args,
+        )
+        instrument_engine(engine, role="primary")
+        self._session_factory = async_sessionmaker(engine, expire_on_commit=False)
+        self._replicas = ReplicaPool(
+            settings.DB_REPLICA_URLS,
+            strategy=settings.DB_REPLICA_STRATEGY,
+            retry_seconds=settings.DB_REPLICA_RETRY_SECONDS,
+            connect_args=connect_args,
+        )
+        self._primary_pins = PrimaryPins(
+            settings.DB_PRIMARY_PIN_SECONDS, settings.SECRET_KEY
+        )
+        self._engine = engine
+
+    @property
+    def engine(self) -> AsyncEngine:
+        self.connect()
+        return self._engine
+
+    @property
+    def replicas(self) -> ReplicaPool:
+        self.connect()
+        return self._replicas
+
+    @property
+    def primary_pins(self) -> PrimaryPins:
+        self.connect()
+        return self._primary_pins
+
+    def session(self) -> AsyncSession:
+        """new session on the primary"""
+        self.connect()
+        return self._session_factory()
+
+    async def warm(
+        self,
+        connections: int,
+        prepare: Callable[[AsyncSession, bool], Awaitable] | None = None,
+    ) -> None:
+        """Opens up to connections pooled connections on every engine.
+
+        prepare(session, read_only) runs on each of them inside a transaction
+        that is rolled back, read_only is true on replicas. A replica that
+        cannot be reached is ejected instead of failing the startup.
+        """
+        await _warm_engine(self.engine, connections, prepare, read_only=False)
+        for replica in self.replicas.engines:
+            try:
+                await _warm_engine(replica, connections, prepare, read_only=True)
+            except (OSError, DBAPIError):
+                logger.warning("replica %s is unreachable", replica.url, exc_info=True)
+                self.replicas.eject(replica)
+
+    async def dispose(self) -> None:
+        if self._engine is None:
+            return
+        for engine in (self._engine, *self._replicas.engines):
+            forget_engine(engine)
+            await engine.dispose()
+        self._engine = None
+
+
+database = Database()
 
 
 async def get_async_session() -> Generator:
     """Dependency for getting async session"""
-    async with async_session() as session:
+    async with database.session() as session:
         yield session
 
 
+async def get_async_read_session(
+    request: Request, primary_session: AsyncSession = Depends(get_async_session)
+) -> Generator:
+    """Dependency for read-only routes, served by a replica when one is healthy.
+
+    Otherwise the request's primary session is shared, which only takes a
+    connection once it is used.
+    """
+    pin = request.cookies.get(PrimaryPins.cookie)
+    if database.primary_pins.is_pinned(pin):
+        replica = None
+    else:
+        replica = database.replicas.choose()
+    if replica is None:
+        yield primary_session
+        return
+    async with AsyncSession(replica, expire_on_commit=False) as session:
+        try:
+            yield session
+        except (OSError, DBAPIError) as err:
+            if isinstance(err, OSError) or err.connection_invalidated:
+                database.replicas.eject(replica)
+            raise
+
+
+async def pin_reads_to_primary(request: Request) -> None:
+    """Dependency for write routes, keeps the caller's next reads on the primary.
+
+    PrimaryPinMiddleware sets the pin cookie on the response.
+    """
+    request.state.pin_primary = True
+
+
+class PrimaryPinMiddleware:
+    """Adds the pin cookie to responses of requests that pinned their caller"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        # shared with the request of the route, which sets pin_primary
+        state = scope.setdefault("state", {})
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and state.get("pin_primary"):
+                headers = list(message.get("headers", []))
+                headers.append((b"set-cookie", database.primary_pins.cookie_header()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        await self.app(scope, receive, send_wrapper)
+
+
+def is_replica_session(session: AsyncSession) -> bool:
+    return session.bind is not database.engine
+
+
 # endregion
@@ -0,0 +1,55 @@
+import asyncio
+from typing import Any
+from typing import Awaitable
+from typing import Callable
+from typing import Hashable
+
+from metrics import db_coalesced_queries
+
+
+class _LeaderCancelled(Exception):
+    """the call the followers waited on was cancelled, they run their own"""
+
+
+def _consume_exception(future: asyncio.Future) -> None:
+    # a failed call without followers must not log "exception never retrieved"
+    future.exception()
+
+
+class SingleFlight:
+    """Concurrent calls with the same key share the result of one in-flight call.
+
+    Nothing is kept after the call finishes, the next call with the key runs
+    again, so this only removes duplicate work during bursts.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self._calls: dict[Hashable, asyncio.Future] = {}
+
+    async def do(
+        self, key: Hashable, func: Callable[..., Awaitable[Any]], *args
+    ) -> Any:
+        while (future := self._calls.get(key)) is not None:
+            db_coalesced_queries.inc(flight=self.name)
+            try:
+                return await asyncio.shield(future)
+            except _LeaderCancelled:
+                continue
+
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        self._calls[key] = future
+        try:
+            result = await func(*args)
+        except Exception as err:
+            future.set_exception(err)
+            raise
+        except BaseException:
+            future.set_exception(_LeaderCancelled())
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            del self._calls[key]
@@ -1,13 +1,248 @@
+import argparse
+import asyncio
+import math
+import time
+from concurrent.futures import Executor
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
 from passlib.context import CryptContext
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+import settings
+from metrics import password_hash_duration
+
+
+def build_context(schemes: list[str]) -> CryptContext:
+    """hashes below or above the configured cost are flagged by needs_update"""
+    policy = {}
+    if "bcrypt" in schemes:
+        policy.update(
+            bcrypt__rounds=settings.BCRYPT_ROUNDS,
+            bcrypt__min_rounds=settings.BCRYPT_ROUNDS,
+        )
+    if "argon2" in schemes:
+        policy.update(
+            argon2__type="ID",
+            argon2__rounds=settings.ARGON2_TIME_COST,
+            argon2__min_rounds=settings.ARGON2_TIME_COST,
+            argon2__memory_cost=settings.ARGON2_MEMORY_COST,
+            argon2__parallelism=settings.ARGON2_PARALLELISM,
+        )
+    return CryptContext(schemes=schemes, deprecated="auto", **policy)
+
+
+pwd_context = build_context(settings.PASSWORD_SCHEMES)
+
+
+def _verify(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def _verify_and_update(
+    plain_password: str, hashed_password: str
+) -> tuple[bool, str | None]:
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+
+def _timed(func, *args):
+    """runs inside the worker, so the measured time excludes queueing"""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+@dataclass
+class HashStats:
+    calls: int = 0
+    total_seconds: float = 0.0
+    max_seconds: float = 0.0
+    queued_seconds: float = 0.0
+
+    @property
+    def avg_seconds(self) -> float:
+        return self.total_seconds / self.calls if self.calls else 0.0
+
+    def observe(self, elapsed: float, queued: float) -> None:
+        self.calls += 1
+        self.total_seconds += elapsed
+        self.max_seconds = max(self.max_seconds, elapsed)
+        self.queued_seconds += queued
+
+
+class HashingPoolFull(Exception):
+    """max_queue calls already wait for a worker, the caller should retry later"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"hashing pool is full, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class HashingPool:
+    """Worker pool that keeps bcrypt off the event loop.
+
+    At most ``workers`` calls are handed to the executor at once and at most
+    ``max_queue`` wait for a free worker, further calls raise HashingPoolFull.
+    """
+
+    def __init__(self, kind: str, workers: int, max_queue: int):
+        if kind not in ("thread", "process"):
+            raise ValueError(f"Unknown hasher pool kind: {kind}")
+        self.kind = kind
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor: Executor | None = None
+        self._slots = asyncio.Semaphore(workers)
+        self._waiting = 0
+        self.stats = {"verify": HashStats(), "hash": HashStats()}
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="hasher"
+                )
+        return self._executor
+
+    def _retry_after(self) -> int:
+        """seconds until the calls waiting now have had a worker"""
+        per_call = max(stats.avg_seconds for stats in self.stats.values())
+        return max(math.ceil(per_call * self._waiting / self.workers), 1)
+
+    async def _acquire(self) -> None:
+        if self._slots.locked() and self._waiting >= self.max_queue:
+            raise HashingPoolFull(self._retry_after())
+        self._waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+
+    async def run(self, operation: str, func, *args):
+        submitted = time.perf_counter()
+        await self._acquire()
+        try:
+            loop = asyncio.get_running_loop()
+            result, elapsed = await loop.run_in_executor(
+                self.executor, _timed, func, *args
+            )
+        finally:
+            self._slots.release()
+        queued = time.perf_counter() - submitted - elapsed
+        self.stats[operation].observe(elapsed, max(queued, 0.0))
+        password_hash_duration.observe(elapsed, operation=operation)
+        return result
+
+    def shutdown(self, wait: bool = True) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+hashing_pool = HashingPool(
+    kind=settings.HASHER_POOL,
+    workers=settings.HASHER_WORKERS,
+    max_queue=settings.HASHER_MAX_QUEUE,
+)
 
 
 class Hasher:
     @staticmethod
     def verify_password(plain_password: str, hashed_password: str):
-        return pwd_context.verify(plain_password, hashed_password)
+        return _verify(plain_password, hashed_password)
 
     @staticmethod
     def get_password_hash(password: str) -> str:
-        return pwd_context.hash(password)
+        return _hash(password)
+
+    @staticmethod
+    async def verify_password_async(plain_password: str, hashed_password: str):
+        return await hashing_pool.run(
+            "verify", _verify, plain_password, hashed_password
+        )
+
+    @staticmethod
+    async def get_password_hash_async(password: str) -> str:
+        return await hashing_pool.run("hash", _hash, password)
+
+    @staticmethod
+    async def get_password_hashes_async(passwords: list[str]) -> list[str]:
+        """hashes workers passwords at a time, logins queue up between the chunks"""
+        hashes = []
+        for start in range(0, len(passwords), hashing_pool.workers):
+            chunk = passwords[start : start + hashing_pool.workers]
+            hashes += await asyncio.gather(
+                *(hashing_pool.run("hash", _hash, password) for password in chunk)
+            )
+        return hashes
+
+    @staticmethod
+    async def verify_and_update_async(
+        plain_password: str, hashed_password: str
+    ) -> tuple[bool, str | None]:
+        """verifies and, if the hash is outdated, also returns a fresh one"""
+        return await hashing_pool.run(
+            "verify", _verify_and_update, plain_password, hashed_password
+        )
+
+
+def _measure(handler, samples: int = 3) -> float:
+    best = float("inf")
+    for _ in range(samples):
+        start = time.perf_counter()
+        handler.hash("calibration-password")
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def calibrate(scheme: str, target_seconds: float) -> dict:
+    """highest cost whose hash time on this host stays within target_seconds"""
+    if scheme == "bcrypt":
+        from passlib.hash import bcrypt
+
+        def handler(cost):
+            return bcrypt.using(rounds=cost)
+
+        setting, costs = "BCRYPT_ROUNDS", range(4, 32)
+    elif scheme == "argon2":
+        from passlib.hash import argon2
+
+        def handler(cost):
+            return argon2.using(
+                type="ID",
+                rounds=cost,
+                memory_cost=settings.ARGON2_MEMORY_COST,
+                parallelism=settings.ARGON2_PARALLELISM,
+            )
+
+        setting, costs = "ARGON2_TIME_COST", range(1, 64)
+    else:
+        raise ValueError(f"Unknown scheme: {scheme}")
+    chosen = None
+    for cost in costs:
+        seconds = _measure(handler(cost))
+        print(f"{setting}={cost}: {seconds * 1000:.1f} ms")
+        if seconds > target_seconds:
+            break
+        chosen = {setting: cost, "seconds": seconds}
+    # even the cheapest cost is over target, fall back to it
+    return chosen or {setting: costs[0], "seconds": _measure(handler(costs[0]))}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Pick the password hash cost for a target latency on this host"
+    )
+    parser.add_argument("--scheme", choices=["bcrypt", "argon2"], default="bcrypt")
+    parser.add_argument("--target-ms", type=float, default=250)
+    args = parser.parse_args()
+    result = calibrate(args.scheme, args.target_ms / 1000)
+    setting, cost = next(iter(result.items()))
+    print(f"{setting}={cost}  # {result['seconds'] * 1000:.1f} ms per hash")
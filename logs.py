@@ -0,0 +1,190 @@
+"""Structured JSON logging that never writes from the event loop.
+
+Loggers only put records on a bounded queue, a listener thread formats and
+writes them. Every record carries the id of the request it was logged in.
+"""
+import json
+import logging
+import queue
+import random
+import re
+import sys
+import zlib
+from contextvars import ContextVar
+from datetime import datetime
+from datetime import timezone
+from logging.handlers import QueueHandler
+from logging.handlers import QueueListener
+from uuid import uuid4
+
+import settings
+from metrics import registry
+
+request_id: ContextVar[str | None] = ContextVar("request_id", default=None)
+
+log_records_dropped = registry.counter(
+    "log_records_dropped_total", "Log records dropped because the queue was full."
+)
+
+_REQUEST_ID_HEADER = b"x-request-id"
+_VALID_REQUEST_ID = re.compile(r"[A-Za-z0-9._:-]{1,128}")
+# attributes every LogRecord has, anything else was passed in extra; uvicorn
+# passes a colored copy of its messages
+_RECORD_ATTRIBUTES = {
+    *vars(logging.makeLogRecord({})),
+    "message",
+    "asctime",
+    "color_message",
+}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "request_id": getattr(record, "request_id", None),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and key not in entry:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class _RequestContextFilter(logging.Filter):
+    """Tags records with the request id and samples those below WARNING.
+
+    Runs in the thread that logs, where the request context is visible.
+    Sampling is decided per request, so a request is logged completely or not
+    at all.
+    """
+
+    def __init__(self, sample_rate: float):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = current = request_id.get()
+        if record.levelno >= logging.WARNING or self.sample_rate >= 1:
+            return True
+        if current is None:
+            return random.random() < self.sample_rate
+        return zlib.crc32(current.encode()) / 2**32 < self.sample_rate
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """drops records instead of blocking when the listener falls behind"""
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_records_dropped.inc()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # keep exc_info for the formatter, QueueHandler would flatten it
+        record.message = record.getMessage()
+        record.msg, record.args = record.message, None
+        return record
+
+
+_listener: QueueListener | None = None
+_queue_handler: QueueHandler | None = None
+
+
+def _parse_levels(value: str) -> dict[str, str]:
+    """LOG_LEVELS such as "uvicorn.access=WARNING,sqlalchemy.engine=INFO" """
+    levels = {}
+    for item in value.split(","):
+        name, _, level = item.partition("=")
+        if name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging() -> None:
+    """routes the root logger and uvicorn's loggers through the queue"""
+    global _listener, _queue_handler
+    shutdown_logging()
+
+    records = queue.Queue(maxsize=settings.LOG_QUEUE_SIZE)
+    queue_handler = _DroppingQueueHandler(records)
+    queue_handler.addFilter(_RequestContextFilter(settings.LOG_SAMPLE_RATE))
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter())
+
+    root = logging.getLogger()
+    for handler in [*root.handlers]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    _queue_handler = queue_handler
+    root.setLevel(settings.LOG_LEVEL)
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        logger = logging.getLogger(name)
+        logger.handlers.clear()
+        logger.propagate = True
+    # pools log every dispose at INFO, the instrumented one under metrics
+    for name in ("sqlalchemy", "metrics"):
+        logging.getLogger(name).setLevel(logging.WARNING)
+    if settings.DB_ECHO:
+        logging.getLogger("sqlalchemy.engine").setLevel(logging.INFO)
+    for name, level in _parse_levels(settings.LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(level)
+
+    _listener = QueueListener(records, output)
+    _listener.start()
+
+
+def shutdown_logging() -> None:
+    """Writes out the queued records and stops the listener thread.
+
+    Records logged afterwards, e.g. by the server while it exits, are written
+    directly.
+    """
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    root = logging.getLogger()
+    root.removeHandler(_queue_handler)
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.addFilter(_RequestContextFilter(sample_rate=1.0))
+        root.addHandler(handler)
+    _listener = _queue_handler = None
+
+
+class RequestIdMiddleware:
+    """Sets the request id from X-Request-ID, or a new one, and echoes it back"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        current = None
+        for name, value in scope["headers"]:
+            if name == _REQUEST_ID_HEADER:
+                current = value.decode("latin-1")
+                break
+        if current is None or not _VALID_REQUEST_ID.fullmatch(current):
+            current = uuid4().hex
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((_REQUEST_ID_HEADER, current.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        token = request_id.set(current)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            request_id.reset(token)
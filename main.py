@@ -1,17 +1,123 @@
+import time
+
+_import_started = time.perf_counter()
+
+import asyncio
+from contextlib import asynccontextmanager
+from logging import getLogger
+
 import uvicorn
 from fastapi import FastAPI
+from fastapi import Request
+from fastapi.responses import JSONResponse
+from sqlalchemy.exc import DBAPIError
+from starlette import status
 
+import settings
 from api.login_router import login_router
 from api.service import service_router
 from api.user_router import user_router
+from db.cache import user_cache
+from db.dals import UserDAL
+from db.maintenance import run_archive_schedule
+from db.session import database
+from db.session import PrimaryPinMiddleware
+from hashing import hashing_pool
+from hashing import HashingPoolFull
+from logs import configure_logging
+from logs import RequestIdMiddleware
+from logs import shutdown_logging
+from metrics import app_startup_duration
+from metrics import flush_snapshots
+from metrics import MetricsMiddleware
+from profiling import profiling_enabled
+from profiling import ProfilingMiddleware
+
+IMPORT_SECONDS = time.perf_counter() - _import_started
+
+logger = getLogger(__name__)
+
+
+async def _prepare_statements(session, read_only: bool) -> None:
+    await UserDAL(session).warm(read_only)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Connects and warms the database pools, disposes them on shutdown.
+
+    Archives deactivated users in the background every ARCHIVE_INTERVAL_SECONDS
+    and, with METRICS_DIR, leaves metrics snapshots there for the other workers.
+    """
+    started = time.perf_counter()
+    database.connect()
+    try:
+        await database.warm(settings.DB_WARM_CONNECTIONS, _prepare_statements)
+    except (OSError, DBAPIError):
+        logger.warning("database warm-up failed", exc_info=True)
+    startup_seconds = time.perf_counter() - started
+    app_startup_duration.set(startup_seconds, phase="startup")
+    logger.info(
+        "app started: import %.3fs, build %.3fs, startup %.3fs",
+        IMPORT_SECONDS,
+        app.state.build_seconds,
+        startup_seconds,
+    )
+    tasks = []
+    if settings.ARCHIVE_INTERVAL_SECONDS > 0:
+        tasks.append(
+            asyncio.create_task(run_archive_schedule(settings.ARCHIVE_INTERVAL_SECONDS))
+        )
+    if settings.METRICS_DIR:
+        tasks.append(
+            asyncio.create_task(
+                flush_snapshots(settings.METRICS_DIR, settings.METRICS_FLUSH_SECONDS)
+            )
+        )
+    try:
+        yield
+    finally:
+        for task in tasks:
+            task.cancel()
+        # an error a task ended with must not skip the cleanup below
+        await asyncio.gather(*tasks, return_exceptions=True)
+        hashing_pool.shutdown()
+        try:
+            await user_cache.close()
+        finally:
+            await database.dispose()
+            shutdown_logging()
+
+
+async def _hashing_pool_full(request: Request, exc: HashingPoolFull) -> JSONResponse:
+    return JSONResponse(
+        {"detail": "Server is busy, try again later."},
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
 
-app = FastAPI(title="oxford university")
+def create_app() -> FastAPI:
+    started = time.perf_counter()
+    configure_logging()
+    app = FastAPI(title="oxford university", lifespan=lifespan)
+    if profiling_enabled():
+        # innermost, so that the request id is set and the profile is all app
+        app.add_middleware(ProfilingMiddleware)
+    app.add_middleware(PrimaryPinMiddleware)
+    app.add_middleware(MetricsMiddleware)
+    app.add_middleware(RequestIdMiddleware)
+    app.add_exception_handler(HashingPoolFull, _hashing_pool_full)
 
+    app.include_router(user_router, prefix="/user", tags=["User"])
+    app.include_router(login_router, prefix="/login", tags=["Login"])
+    app.include_router(service_router, tags=["Ping"])
 
-app.include_router(user_router, prefix="/user", tags=["User"])
-app.include_router(login_router, prefix="/login", tags=["Login"])
-app.include_router(service_router, tags=["Ping"])
+    app.state.build_seconds = time.perf_counter() - started
+    app_startup_duration.set(IMPORT_SECONDS, phase="import")
+    app_startup_duration.set(app.state.build_seconds, phase="build")
+    return app
 
 
 if __name__ == "__main__":
-    uvicorn.run("main:app", reload=True)
+    uvicorn.run("main:create_app", factory=True, reload=True)
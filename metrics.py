@@ -0,0 +1,424 @@
+"""In-process metrics rendered in the Prometheus text exposition format.
+
+Under server.py with several workers each worker writes a snapshot of its
+metrics to METRICS_DIR every METRICS_FLUSH_SECONDS, and /metrics of any
+worker renders the sum of all snapshots. Gauges are not summed but keep one
+value per worker, labelled with its pid.
+"""
+import asyncio
+import json
+import os
+import time
+from bisect import bisect_left
+from logging import getLogger
+from pathlib import Path
+from typing import Callable
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+logger = getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# snapshot holding the totals of exited workers
+_RETIRED = "retired"
+
+
+def _format_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in labels
+    )
+    return "{" + pairs + "}"
+
+
+def _dump_labels(labels: tuple[tuple[str, str], ...]) -> str:
+    return json.dumps(labels)
+
+
+def _load_labels(key: str) -> tuple[tuple[str, str], ...]:
+    return tuple(tuple(pair) for pair in json.loads(key))
+
+
+def _add(value, other):
+    """sums counter values, or histogram bucket counts and sums"""
+    if isinstance(value, list):
+        return [a + b for a, b in zip(value, other)]
+    return value + other
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(tuple(sorted(labels.items())), 0)
+
+    def blank(self) -> "Counter":
+        return Counter(self.name, self.documentation)
+
+    def dump(self) -> dict[str, float]:
+        return {_dump_labels(labels): value for labels, value in self._values.items()}
+
+    def load(self, values: dict[str, float], worker: str) -> None:
+        for key, value in values.items():
+            labels = _load_labels(key)
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def collect(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values: dict[tuple, float] = {}
+
+    def set(self, value: float, **labels) -> None:
+        self._values[tuple(sorted(labels.items()))] = value
+
+    def clear(self) -> None:
+        self._values.clear()
+
+    def blank(self) -> "Gauge":
+        return Gauge(self.name, self.documentation)
+
+    def dump(self) -> dict[str, float]:
+        return {_dump_labels(labels): value for labels, value in self._values.items()}
+
+    def load(self, values: dict[str, float], worker: str) -> None:
+        for key, value in values.items():
+            labels = tuple(sorted((*_load_labels(key), ("pid", worker))))
+            self._values[labels] = value
+
+    def collect(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} gauge",
+        ]
+        for labels, value in self._values.items():
+            lines.append(f"{self.name}{_format_labels(labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        # per label set: bucket counts (last one is +Inf), sum
+        self._values: dict[tuple, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        entry = self._values.get(key)
+        if entry is None:
+            entry = self._values[key] = ([0] * (len(self.buckets) + 1), [0.0])
+        counts, total = entry
+        counts[bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    def blank(self) -> "Histogram":
+        return Histogram(self.name, self.documentation, self.buckets)
+
+    def dump(self) -> dict[str, list[float]]:
+        """bucket counts followed by the sum, per label set"""
+        return {
+            _dump_labels(labels): [*counts, total[0]]
+            for labels, (counts, total) in self._values.items()
+        }
+
+    def load(self, values: dict[str, list[float]], worker: str) -> None:
+        for key, value in values.items():
+            if len(value) != len(self.buckets) + 2:
+                # written by a worker with other buckets
+                continue
+            labels = _load_labels(key)
+            counts, total = self._values.setdefault(
+                labels, ([0] * (len(self.buckets) + 1), [0.0])
+            )
+            counts[:] = _add(counts, value[:-1])
+            total[0] += value[-1]
+
+    def collect(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += count
+                bucket_labels = _format_labels((*labels, ("le", bound)))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total[0]}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: list[Counter | Gauge | Histogram] = []
+        self._collectors: list[Callable[[], None]] = []
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        metric = Counter(name, documentation)
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, documentation: str) -> Gauge:
+        metric = Gauge(name, documentation)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, documentation: str, **kwargs) -> Histogram:
+        metric = Histogram(name, documentation, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        """collector runs before every render and snapshot, to set on-demand gauges"""
+        self._collectors.append(collector)
+
+    def _collect(self) -> None:
+        for collector in self._collectors:
+            collector()
+
+    def render(self) -> str:
+        self._collect()
+        return _render(self._metrics)
+
+    def snapshot(self) -> dict:
+        """values of this process, gauges apart as they are not summed"""
+        self._collect()
+        return {
+            "totals": {
+                metric.name: metric.dump()
+                for metric in self._metrics
+                if not isinstance(metric, Gauge)
+            },
+            "gauges": {
+                metric.name: metric.dump()
+                for metric in self._metrics
+                if isinstance(metric, Gauge)
+            },
+        }
+
+    def render_snapshots(self, snapshots: dict[str, dict]) -> str:
+        """the sum of the snapshots of all workers, by worker pid"""
+        metrics = [metric.blank() for metric in self._metrics]
+        for worker, snapshot in snapshots.items():
+            values = {**snapshot.get("totals", {}), **snapshot.get("gauges", {})}
+            for metric in metrics:
+                metric.load(values.get(metric.name, {}), worker)
+        return _render(metrics)
+
+
+def _render(metrics: list[Counter | Gauge | Histogram]) -> str:
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.collect())
+    return "\n".join(lines) + "\n"
+
+
+def write_snapshot(directory: str, snapshot: dict, name: str | None = None) -> None:
+    """replaces the snapshot file at once, readers never see a partial one"""
+    path = Path(directory) / f"{name or os.getpid()}.json"
+    partial = path.with_suffix(".tmp")
+    partial.write_text(json.dumps(snapshot))
+    os.replace(partial, path)
+
+
+def read_snapshots(directory: str) -> dict[str, dict]:
+    snapshots = {}
+    for path in Path(directory).glob("*.json"):
+        try:
+            snapshots[path.stem] = json.loads(path.read_text())
+        except FileNotFoundError:
+            # retired in the meantime
+            continue
+    return snapshots
+
+
+def clear_snapshots(directory: str) -> None:
+    for path in Path(directory).glob("*.json"):
+        path.unlink(missing_ok=True)
+
+
+def retire_snapshot(directory: str, pid: int) -> None:
+    """Folds the totals of an exited worker into the retired snapshot.
+
+    Counters keep growing across worker restarts, the gauges of the worker go.
+    """
+    path = Path(directory) / f"{pid}.json"
+    try:
+        totals = json.loads(path.read_text())["totals"]
+    except FileNotFoundError:
+        return
+    retired = read_snapshots(directory).get(_RETIRED, {}).get("totals", {})
+    for name, values in totals.items():
+        merged = retired.setdefault(name, {})
+        for key, value in values.items():
+            merged[key] = _add(merged[key], value) if key in merged else value
+    write_snapshot(directory, {"totals": retired}, name=_RETIRED)
+    path.unlink()
+
+
+async def flush_snapshots(directory: str, interval: float) -> None:
+    """Writes the snapshot of this worker every interval seconds.
+
+    A last one is written when the task is cancelled on shutdown.
+    """
+    try:
+        while True:
+            try:
+                await asyncio.to_thread(write_snapshot, directory, registry.snapshot())
+            except OSError:
+                logger.warning("writing the metrics snapshot failed", exc_info=True)
+            await asyncio.sleep(interval)
+    finally:
+        write_snapshot(directory, registry.snapshot())
+
+
+registry = Registry()
+
+app_startup_duration = registry.gauge(
+    "app_startup_seconds", "Time the last app start spent per phase."
+)
+http_requests = registry.counter(
+    "http_requests_total", "HTTP requests by route, method and status."
+)
+http_request_duration = registry.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route and method."
+)
+db_queries = registry.counter(
+    "db_queries_total", "SQL statements executed by statement kind."
+)
+db_query_duration = registry.histogram(
+    "db_query_duration_seconds", "SQL statement execution time by statement kind."
+)
+db_coalesced_queries = registry.counter(
+    "db_coalesced_queries_total",
+    "Lookups that joined an identical in-flight query instead of running one.",
+)
+db_pool_checkout_duration = registry.histogram(
+    "db_pool_checkout_seconds", "Time to check a connection out of the pool."
+)
+password_hash_duration = registry.histogram(
+    "password_hash_seconds",
+    "Time spent in the password hasher per call, by operation.",
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 0.75, 1.0, 2.0),
+)
+
+
+class MetricsMiddleware:
+    """Records latency and status of every HTTP request by route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            path = route.path if route is not None else "<unmatched>"
+            method = scope["method"]
+            http_request_duration.observe(
+                time.perf_counter() - start, route=path, method=method
+            )
+            http_requests.inc(route=path, method=method, status=status_code)
+
+
+class TimedAsyncAdaptedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool that records how long each checkout waited"""
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            db_pool_checkout_duration.observe(time.perf_counter() - start)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, many):
+    context._query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, many):
+    started = getattr(context, "_query_started", None)
+    if started is not None:
+        kind = statement.lstrip().split(None, 1)[0].upper() if statement else ""
+        db_query_duration.observe(time.perf_counter() - started, statement=kind)
+        db_queries.inc(statement=kind)
+
+
+_engines: dict[AsyncEngine, dict[str, str]] = {}
+db_pool_size = registry.gauge("db_pool_size", "Connections the pool keeps open.")
+db_pool_checked_out = registry.gauge(
+    "db_pool_checked_out", "Connections currently in use."
+)
+db_pool_overflow = registry.gauge(
+    "db_pool_overflow", "Connections opened beyond the pool size."
+)
+_POOL_GAUGES = {
+    db_pool_size: "size",
+    db_pool_checked_out: "checkedout",
+    db_pool_overflow: "overflow",
+}
+
+
+def _collect_pools() -> None:
+    for gauge, method in _POOL_GAUGES.items():
+        gauge.clear()
+        for engine, labels in _engines.items():
+            pool = engine.sync_engine.pool
+            if isinstance(pool, AsyncAdaptedQueuePool):
+                gauge.set(getattr(pool, method)(), **labels)
+
+
+registry.add_collector(_collect_pools)
+
+
+def instrument_engine(engine: AsyncEngine, role: str) -> None:
+    """times every statement and exposes pool occupancy of the engine"""
+    event.listen(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+    _engines[engine] = {"engine": role, "host": engine.url.host}
+
+
+def forget_engine(engine: AsyncEngine) -> None:
+    """stops instrumenting an engine that is being disposed"""
+    event.remove(engine.sync_engine, "before_cursor_execute", _before_cursor_execute)
+    event.remove(engine.sync_engine, "after_cursor_execute", _after_cursor_execute)
+    _engines.pop(engine, None)
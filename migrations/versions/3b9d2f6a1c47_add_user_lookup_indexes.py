@@ -0,0 +1,56 @@
+"""add user lookup indexes
+
+Revision ID: 3b9d2f6a1c47
+Revises: ffd45b10cb7d
+Create Date: 2026-10-18 10:12:41.118305
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "3b9d2f6a1c47"
+down_revision = "ffd45b10cb7d"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_users_id_active",
+            "users",
+            ["id"],
+            postgresql_where=sa.text("is_active"),
+            postgresql_concurrently=True,
+        )
+        op.create_index(
+            "ix_users_email_active",
+            "users",
+            ["email"],
+            postgresql_where=sa.text("is_active"),
+            postgresql_concurrently=True,
+        )
+        op.create_index(
+            "ix_users_email_lower",
+            "users",
+            [sa.text("lower(email)")],
+            postgresql_concurrently=True,
+        )
+        op.create_index(
+            "ix_users_roles",
+            "users",
+            ["roles"],
+            postgresql_using="gin",
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_users_roles", "users", postgresql_concurrently=True)
+        op.drop_index("ix_users_email_lower", "users", postgresql_concurrently=True)
+        op.drop_index("ix_users_email_active", "users", postgresql_concurrently=True)
+        op.drop_index("ix_users_id_active", "users", postgresql_concurrently=True)
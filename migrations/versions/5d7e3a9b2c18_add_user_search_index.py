@@ -0,0 +1,36 @@
+"""add user search index
+
+Revision ID: 5d7e3a9b2c18
+Revises: 8e1f4c2d7a90
+Create Date: 2026-10-18 15:02:36.904127
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "5d7e3a9b2c18"
+down_revision = "8e1f4c2d7a90"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_users_search_trgm",
+            "users",
+            [sa.text("(name || ' ' || surname || ' ' || email) gin_trgm_ops")],
+            postgresql_using="gin",
+            postgresql_where=sa.text("is_active"),
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    # pg_trgm stays installed, other objects may depend on it
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_users_search_trgm", "users", postgresql_concurrently=True)
@@ -0,0 +1,62 @@
+"""add users archive
+
+Revision ID: a4f7c9e1d362
+Revises: 5d7e3a9b2c18
+Create Date: 2026-10-18 16:21:48.330917
+
+"""
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = "a4f7c9e1d362"
+down_revision = "5d7e3a9b2c18"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.add_column(
+        "users", sa.Column("deactivated_at", sa.DateTime(timezone=True), nullable=True)
+    )
+    # users deactivated before the column existed start their retention now
+    op.execute("UPDATE users SET deactivated_at = now() WHERE NOT is_active")
+    op.create_table(
+        "users_archive",
+        sa.Column("id", sa.UUID(), nullable=False),
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("surname", sa.String(), nullable=False),
+        sa.Column("email", sa.String(), nullable=False),
+        sa.Column("roles", postgresql.ARRAY(sa.String()), nullable=False),
+        sa.Column("version", sa.Integer(), nullable=False),
+        sa.Column("deactivated_at", sa.DateTime(timezone=True), nullable=False),
+        sa.Column(
+            "archived_at",
+            sa.DateTime(timezone=True),
+            server_default=sa.text("now()"),
+            nullable=False,
+        ),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.create_index(
+        op.f("ix_users_archive_email"), "users_archive", ["email"], unique=False
+    )
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_users_deactivated_at",
+            "users",
+            ["deactivated_at"],
+            postgresql_where=sa.text("NOT is_active"),
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_users_deactivated_at", "users", postgresql_concurrently=True)
+    op.drop_index(op.f("ix_users_archive_email"), table_name="users_archive")
+    op.drop_table("users_archive")
+    op.drop_column("users", "deactivated_at")
@@ -0,0 +1,49 @@
+"""drop unused user indexes
+
+Revision ID: d9a1f3c6e2b8
+Revises: c2e8b5a7f013
+Create Date: 2026-10-18 17:31:40.227815
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = "d9a1f3c6e2b8"
+down_revision = "c2e8b5a7f013"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # no query filters on lower(email), lookups by email use the unique email
+    # index and lookups by id the primary key
+    with op.get_context().autocommit_block():
+        op.drop_index("ix_users_email_active", "users", postgresql_concurrently=True)
+        op.drop_index("ix_users_email_lower", "users", postgresql_concurrently=True)
+        op.drop_index("ix_users_id_active", "users", postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        op.create_index(
+            "ix_users_id_active",
+            "users",
+            ["id"],
+            postgresql_where=sa.text("is_active"),
+            postgresql_concurrently=True,
+        )
+        op.create_index(
+            "ix_users_email_active",
+            "users",
+            ["email"],
+            postgresql_where=sa.text("is_active"),
+            postgresql_concurrently=True,
+        )
+        op.create_index(
+            "ix_users_email_lower",
+            "users",
+            [sa.text("lower(email)")],
+            postgresql_concurrently=True,
+        )
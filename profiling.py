@@ -0,0 +1,148 @@
+"""On-demand profiling of single requests with pyinstrument.
+
+A request is profiled when it carries X-Profile with PROFILING_TOKEN, or is
+picked by PROFILING_SAMPLE_RATE. The profile is written to PROFILING_DIR in
+the folded stack format read by flamegraph.pl and speedscope, named after
+the request id which is returned in X-Profile-Id. Only the newest
+PROFILING_MAX_FILES profiles are kept.
+
+Time spent awaiting, e.g. on the database or on the hashing pool which runs
+bcrypt off the event loop, shows up as [await] under the awaiting frame.
+"""
+import asyncio
+import hmac
+import random
+import re
+import time
+from logging import getLogger
+from pathlib import Path
+
+import settings
+from logs import request_id
+from metrics import registry
+
+logger = getLogger(__name__)
+
+request_profiles = registry.counter(
+    "request_profiles_total", "Requests picked for profiling by trigger and result."
+)
+
+_PROFILE_HEADER = b"x-profile"
+_PROFILE_ID_HEADER = b"x-profile-id"
+_UNSAFE_NAME = re.compile(r"[^A-Za-z0-9._-]+")
+
+# one profile at a time per worker, a second profiler would disturb the first
+_profiling = False
+
+
+def _frame_name(frame) -> str:
+    if frame.is_synthetic:
+        # [await] and [self], their file and line are those of the parent
+        name = frame.function
+    else:
+        name = f"{frame.function} ({frame.file_path_short}:{frame.line_no})"
+    return name.replace(";", ":")
+
+
+def folded_stacks(root_frame) -> list[str]:
+    """pyinstrument frames as "outer;inner microseconds" lines, by self time"""
+    stacks: dict[str, float] = {}
+    pending = [(root_frame, _frame_name(root_frame))]
+    while pending:
+        frame, path = pending.pop()
+        self_time = frame.time - sum(child.time for child in frame.children)
+        if self_time > 0:
+            stacks[path] = stacks.get(path, 0) + self_time
+        for child in frame.children:
+            pending.append((child, f"{path};{_frame_name(child)}"))
+    return [f"{path} {round(seconds * 1_000_000)}" for path, seconds in stacks.items()]
+
+
+def _write_profile(directory: Path, name: str, lines: list[str], keep: int) -> None:
+    directory.mkdir(parents=True, exist_ok=True)
+    (directory / name).write_text("\n".join(lines) + "\n")
+    profiles = sorted(directory.glob("*.folded"), key=lambda path: path.stat().st_mtime)
+    for path in profiles[: max(len(profiles) - keep, 0)]:
+        path.unlink(missing_ok=True)
+
+
+def profiling_enabled() -> bool:
+    if not settings.PROFILING_TOKEN and settings.PROFILING_SAMPLE_RATE <= 0:
+        return False
+    try:
+        import pyinstrument  # noqa: F401
+    except ImportError:
+        logger.warning("request profiling is configured but pyinstrument is missing")
+        return False
+    return True
+
+
+class ProfilingMiddleware:
+    """Profiles the requests picked by the header or the sample rate.
+
+    Only added to the app when profiling_enabled(), other requests pay for a
+    header lookup and a random number.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.token = settings.PROFILING_TOKEN.encode()
+        self.sample_rate = settings.PROFILING_SAMPLE_RATE
+        self.directory = Path(settings.PROFILING_DIR)
+
+    def _trigger(self, scope) -> str | None:
+        if self.token:
+            for name, value in scope["headers"]:
+                if name == _PROFILE_HEADER:
+                    if hmac.compare_digest(value, self.token):
+                        return "header"
+                    break
+        if random.random() < self.sample_rate:
+            return "sample"
+
+    async def __call__(self, scope, receive, send):
+        global _profiling
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        trigger = self._trigger(scope)
+        if trigger is None:
+            return await self.app(scope, receive, send)
+        if _profiling:
+            request_profiles.inc(trigger=trigger, result="busy")
+            return await self.app(scope, receive, send)
+
+        from pyinstrument import Profiler
+
+        path = _UNSAFE_NAME.sub("_", scope["path"]).strip("_") or "root"
+        profile_id = f"{time.strftime('%Y%m%dT%H%M%S')}-{request_id.get()}"
+        name = f"{profile_id}-{scope['method']}-{path}.folded"
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((_PROFILE_ID_HEADER, profile_id.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        profiler = Profiler(
+            interval=settings.PROFILING_INTERVAL_SECONDS, async_mode="enabled"
+        )
+        _profiling = True
+        profiler.start()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            session = profiler.stop()
+            _profiling = False
+            root_frame = session.root_frame()
+            if root_frame is None:
+                request_profiles.inc(trigger=trigger, result="empty")
+            else:
+                await asyncio.to_thread(
+                    _write_profile,
+                    self.directory,
+                    name,
+                    folded_stacks(root_frame),
+                    settings.PROFILING_MAX_FILES,
+                )
+                request_profiles.inc(trigger=trigger, result="written")
@@ -1,9 +1,137 @@
+import hashlib
+import time
+from collections import OrderedDict
 from datetime import datetime
 from datetime import timedelta
+from functools import cache
 
+from jose import jwk
 from jose import jwt
+from jose import JWTError
 
 import settings
+from db.models import User
+
+
+def stateless_claims(user: User) -> dict:
+    """claims needed to rebuild the principal without a database lookup"""
+    return {
+        "uid": str(user.id),
+        "name": user.name,
+        "surname": user.surname,
+        "roles": list(user.roles),
+        "ver": user.token_version,
+        "rev": user.version,
+    }
+
+
+class TokenError(Exception):
+    """token is malformed, expired or has an invalid signature"""
+
+
+class JoseBackend:
+    """python-jose with the signing key object built once"""
+
+    def __init__(self, secret_key: str, algorithm: str):
+        self.algorithm = algorithm
+        self._key = jwk.construct(secret_key, algorithm)
+
+    def encode(self, claims: dict) -> str:
+        return jwt.encode(claims, self._key, algorithm=self.algorithm)
+
+    def decode(self, token: str) -> dict:
+        try:
+            return jwt.decode(token, self._key, algorithms=[self.algorithm])
+        except JWTError as err:
+            raise TokenError(str(err)) from err
+
+
+class PyJWTBackend:
+    """PyJWT, noticeably faster at decoding than python-jose"""
+
+    def __init__(self, secret_key: str, algorithm: str):
+        import jwt as pyjwt
+
+        self._jwt = pyjwt
+        self.algorithm = algorithm
+        self._key = secret_key.encode()
+
+    def encode(self, claims: dict) -> str:
+        return self._jwt.encode(claims, self._key, algorithm=self.algorithm)
+
+    def decode(self, token: str) -> dict:
+        try:
+            return self._jwt.decode(token, self._key, algorithms=[self.algorithm])
+        except self._jwt.PyJWTError as err:
+            raise TokenError(str(err)) from err
+
+
+JWT_BACKENDS = {"jose": JoseBackend, "pyjwt": PyJWTBackend}
+
+
+def get_jwt_backend(name: str):
+    try:
+        backend_class = JWT_BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Unknown JWT backend: {name}")
+    return backend_class(settings.SECRET_KEY, settings.ALGORITHM)
+
+
+@cache
+def jwt_backend():
+    """backend selected by settings, built on first use"""
+    return get_jwt_backend(settings.JWT_BACKEND)
+
+
+class TokenCache:
+    """Bounded LRU of verified token payloads keyed by the token digest.
+
+    Entries expire at the token's ``exp``, so a cached payload is never
+    served for a token the backend would reject as expired.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._entries: OrderedDict[bytes, tuple[float, dict]] = OrderedDict()
+
+    @staticmethod
+    def _digest(token: str) -> bytes:
+        return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+    def get(self, token: str) -> dict | None:
+        key = self._digest(token)
+        entry = self._entries.get(key)
+        if entry is None:
+            return
+        expires_at, payload = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            return
+        self._entries.move_to_end(key)
+        return payload
+
+    def set(self, token: str, payload: dict) -> None:
+        expires_at = payload.get("exp")
+        if self.maxsize <= 0 or not isinstance(expires_at, (int, float)):
+            return
+        self._entries[self._digest(token)] = (expires_at, payload)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+token_cache = TokenCache(settings.TOKEN_CACHE_SIZE)
+
+
+def decode_access_token(token: str) -> dict:
+    """verified token payload, raises TokenError for an invalid token"""
+    payload = token_cache.get(token)
+    if payload is None:
+        payload = jwt_backend().decode(token)
+        token_cache.set(token, payload)
+    return payload
 
 
 def create_access_token(data: dict, expires_delta: timedelta = None):
@@ -16,5 +144,5 @@ def create_access_token(data: dict, expires_delta: timedelta = None):
         )
 
     to_encode.update({"exp": expire})
-    encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, settings.ALGORITHM)
+    encoded_jwt = jwt_backend().encode(to_encode)
     return encoded_jwt
@@ -0,0 +1,168 @@
+"""Production server: a supervisor process keeping uvicorn workers running.
+
+    python server.py
+
+Workers share one listening socket and run uvloop and httptools. A worker
+is replaced when it dies or, to contain memory growth, after
+SERVER_MAX_REQUESTS requests plus a random jitter so that workers do not
+restart together. When DB_CONNECTION_BUDGET is set every worker gets an
+equal share of it as its own pool, per database. Unless HASHER_WORKERS is
+set, the CPUs are split between the hashing pools of the workers. Metrics
+of all workers are summed on /metrics through snapshots in METRICS_DIR, a
+temporary directory unless set.
+
+Workers are plain spawned processes running uvicorn.Server: uvicorn's own
+multi-worker mode does not replace exited workers, which would drain the
+pool once limit_max_requests is reached.
+"""
+import logging
+import multiprocessing
+import os
+import random
+import shutil
+import signal
+import tempfile
+import threading
+from multiprocessing.context import SpawnProcess
+from socket import socket
+
+import uvicorn
+
+import settings
+from metrics import clear_snapshots
+from metrics import retire_snapshot
+
+logger = logging.getLogger("uvicorn.error")
+
+# the listening socket is passed to the spawned workers
+multiprocessing.allow_connection_pickling()
+_spawn = multiprocessing.get_context("spawn")
+
+
+def worker_pool_size(budget: int, workers: int) -> int:
+    return max(budget // workers, 1)
+
+
+def _serve(config: uvicorn.Config, sockets: list[socket]) -> None:
+    """runs in the worker process"""
+    config.configure_logging()
+    uvicorn.Server(config).run(sockets=sockets)
+
+
+def _config(limit_max_requests: int | None = None) -> uvicorn.Config:
+    return uvicorn.Config(
+        "main:create_app",
+        factory=True,
+        host=settings.SERVER_HOST,
+        port=settings.SERVER_PORT,
+        loop=settings.SERVER_LOOP,
+        http=settings.SERVER_HTTP,
+        backlog=settings.SERVER_BACKLOG,
+        timeout_keep_alive=settings.SERVER_KEEPALIVE_SECONDS,
+        timeout_graceful_shutdown=settings.SERVER_GRACEFUL_TIMEOUT,
+        limit_max_requests=limit_max_requests,
+    )
+
+
+class Supervisor:
+    """Runs workers uvicorn processes on a shared socket and respawns them"""
+
+    def __init__(
+        self,
+        workers: int,
+        max_requests: int,
+        max_requests_jitter: int,
+        metrics_dir: str = "",
+    ):
+        self.workers = workers
+        self.max_requests = max_requests
+        self.max_requests_jitter = max_requests_jitter
+        self.metrics_dir = metrics_dir
+        self._should_exit = threading.Event()
+
+    def _spawn(self, sockets: list[socket]) -> SpawnProcess:
+        limit = None
+        if self.max_requests > 0:
+            limit = self.max_requests + random.randint(0, self.max_requests_jitter)
+        config = _config(limit_max_requests=limit)
+        process = _spawn.Process(
+            target=_serve, kwargs={"config": config, "sockets": sockets}
+        )
+        process.start()
+        return process
+
+    def _handle_exit(self, signum, frame) -> None:
+        self._should_exit.set()
+
+    def _retire(self, process: SpawnProcess) -> None:
+        """keeps the counters of an exited worker in the metrics of the rest"""
+        if self.metrics_dir:
+            retire_snapshot(self.metrics_dir, process.pid)
+
+    def run(self) -> None:
+        config = _config()
+        sock = config.bind_socket()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, self._handle_exit)
+        if self.metrics_dir:
+            # snapshots of a previous run would be summed with this one
+            clear_snapshots(self.metrics_dir)
+
+        processes = [self._spawn([sock]) for _ in range(self.workers)]
+        logger.info("Started %s workers", self.workers)
+        while not self._should_exit.wait(0.5):
+            for index, process in enumerate(processes):
+                if process.is_alive():
+                    continue
+                process.join()
+                self._retire(process)
+                logger.info(
+                    "Worker %s exited with code %s, starting a new one",
+                    process.pid,
+                    process.exitcode,
+                )
+                if process.exitcode:
+                    # a worker that fails on startup must not spin the supervisor
+                    self._should_exit.wait(1)
+                processes[index] = self._spawn([sock])
+
+        # SIGTERM lets each worker finish its in-flight requests
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+            self._retire(process)
+        sock.close()
+
+
+def main():
+    workers = settings.SERVER_WORKERS
+    # inherited by the workers, e.g. a per-process cache is only safe for one
+    os.environ["SERVER_WORKER_PROCESSES"] = str(workers)
+    if settings.DB_CONNECTION_BUDGET > 0:
+        # inherited by the workers, which read settings on first use
+        pool_size = worker_pool_size(settings.DB_CONNECTION_BUDGET, workers)
+        os.environ["DB_POOL_SIZE"] = str(pool_size)
+        os.environ["DB_MAX_OVERFLOW"] = "0"
+    if "HASHER_WORKERS" not in os.environ:
+        # each worker has its own hashing pool, together they use every CPU
+        hasher_workers = worker_pool_size(os.cpu_count() or 1, workers)
+        os.environ["HASHER_WORKERS"] = str(hasher_workers)
+    metrics_dir = settings.METRICS_DIR
+    temporary_metrics_dir = workers > 1 and not metrics_dir
+    if temporary_metrics_dir:
+        metrics_dir = os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="metrics-")
+    try:
+        Supervisor(
+            workers,
+            max_requests=settings.SERVER_MAX_REQUESTS,
+            max_requests_jitter=settings.SERVER_MAX_REQUESTS_JITTER,
+            metrics_dir=metrics_dir,
+        ).run()
+    finally:
+        if temporary_metrics_dir:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
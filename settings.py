@@ -1,10 +1,166 @@
+"""Application settings read from the environment.
+
+Values are parsed on first access and then kept as module attributes, so
+importing a module that uses settings does not require the environment.
+"""
 import os
+from typing import Any
+from typing import Callable
 
 from dotenv import load_dotenv
 
 load_dotenv()
 
-DB_URL = os.getenv("DB_URL")
-ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES"))
-SECRET_KEY = os.getenv("SECRET_KEY")
-ALGORITHM = os.getenv("ALGORITHM")
+
+def _split(value: str) -> list[str]:
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+
+def _flag(name: str, default: str) -> bool:
+    return os.getenv(name, default).lower() in ("1", "true", "yes")
+
+
+_SETTINGS: dict[str, Callable[[], Any]] = {
+    "DB_URL": lambda: os.getenv("DB_URL"),
+    "ACCESS_TOKEN_EXPIRE_MINUTES": lambda: int(
+        os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES")
+    ),
+    "SECRET_KEY": lambda: os.getenv("SECRET_KEY"),
+    "ALGORITHM": lambda: os.getenv("ALGORITHM"),
+    # password hashing worker pool: "thread" or "process"
+    "HASHER_POOL": lambda: os.getenv("HASHER_POOL", "thread"),
+    "HASHER_WORKERS": lambda: int(os.getenv("HASHER_WORKERS", os.cpu_count() or 1)),
+    "HASHER_MAX_QUEUE": lambda: int(os.getenv("HASHER_MAX_QUEUE", 64)),
+    # build the authenticated principal from JWT claims, only the user's token
+    # version is read from the database to honour revocations
+    "STATELESS_AUTH": lambda: os.getenv("STATELESS_AUTH", "false").lower()
+    in ("1", "true", "yes"),
+    # "jose" (python-jose) or "pyjwt" (requires PyJWT)
+    "JWT_BACKEND": lambda: os.getenv("JWT_BACKEND", "jose"),
+    # verified token payloads kept in memory, 0 disables the cache
+    "TOKEN_CACHE_SIZE": lambda: int(os.getenv("TOKEN_CACHE_SIZE", 10000)),
+    # bulk user import limits
+    "USER_BULK_MAX_ROWS": lambda: int(os.getenv("USER_BULK_MAX_ROWS", 20000)),
+    "USER_BULK_BATCH_SIZE": lambda: int(os.getenv("USER_BULK_BATCH_SIZE", 1000)),
+    # rows fetched per round trip when streaming the user listing
+    "USER_STREAM_CHUNK_SIZE": lambda: int(os.getenv("USER_STREAM_CHUNK_SIZE", 1000)),
+    # comma separated read replica URLs, reads go to the primary when empty
+    "DB_REPLICA_URLS": lambda: _split(os.getenv("DB_REPLICA_URLS", "")),
+    # "round_robin" or "least_connections"
+    "DB_REPLICA_STRATEGY": lambda: os.getenv("DB_REPLICA_STRATEGY", "round_robin"),
+    # how long a replica that failed to connect is kept out of rotation
+    "DB_REPLICA_RETRY_SECONDS": lambda: int(os.getenv("DB_REPLICA_RETRY_SECONDS", 30)),
+    # how long reads of a caller that just wrote stay on the primary
+    "DB_PRIMARY_PIN_SECONDS": lambda: int(os.getenv("DB_PRIMARY_PIN_SECONDS", 5)),
+    # asyncpg prepared statements kept per connection, 0 disables (e.g. pgbouncer)
+    "DB_PREPARED_STATEMENT_CACHE_SIZE": lambda: int(
+        os.getenv("DB_PREPARED_STATEMENT_CACHE_SIZE", 100)
+    ),
+    # connections each engine keeps open and may open beyond that under load
+    "DB_POOL_SIZE": lambda: int(os.getenv("DB_POOL_SIZE", 5)),
+    "DB_MAX_OVERFLOW": lambda: int(os.getenv("DB_MAX_OVERFLOW", 10)),
+    # connections all server workers may hold to one database together, server.py
+    # splits it into per-worker pools without overflow; 0 keeps DB_POOL_SIZE
+    "DB_CONNECTION_BUDGET": lambda: int(os.getenv("DB_CONNECTION_BUDGET", 0)),
+    # connections per engine opened at startup, 0 connects on the first request
+    "DB_WARM_CONNECTIONS": lambda: int(os.getenv("DB_WARM_CONNECTIONS", 2)),
+    # log SQL statements through the app logging
+    "DB_ECHO": lambda: os.getenv("DB_ECHO", "false").lower() in ("1", "true", "yes"),
+    # root log level and per logger overrides, e.g. "uvicorn.access=WARNING"
+    "LOG_LEVEL": lambda: os.getenv("LOG_LEVEL", "INFO").upper(),
+    "LOG_LEVELS": lambda: os.getenv("LOG_LEVELS", ""),
+    # share of requests whose records below WARNING are logged
+    "LOG_SAMPLE_RATE": lambda: float(os.getenv("LOG_SAMPLE_RATE", 1.0)),
+    # records waiting for the writer thread, newer ones are dropped beyond it
+    "LOG_QUEUE_SIZE": lambda: int(os.getenv("LOG_QUEUE_SIZE", 10000)),
+    # user lookup cache: "memory" (per process, only used with a single server
+    # worker), "redis" (shared) or "none"
+    "USER_CACHE_BACKEND": lambda: os.getenv("USER_CACHE_BACKEND", "memory"),
+    # redis URL of the shared backend, requires the redis package
+    "USER_CACHE_URL": lambda: os.getenv("USER_CACHE_URL", "redis://localhost:6379/0"),
+    "USER_CACHE_MAX_ENTRIES": lambda: int(os.getenv("USER_CACHE_MAX_ENTRIES", 10000)),
+    # a process only sees its own writes with the memory backend, keep this short
+    "USER_CACHE_TTL_SECONDS": lambda: float(os.getenv("USER_CACHE_TTL_SECONDS", 30)),
+    # how long a lookup that found no active user is remembered
+    "USER_CACHE_NEGATIVE_TTL_SECONDS": lambda: float(
+        os.getenv("USER_CACHE_NEGATIVE_TTL_SECONDS", 5)
+    ),
+    # deactivated users are moved to users_archive after this many days
+    "USER_RETENTION_DAYS": lambda: float(os.getenv("USER_RETENTION_DAYS", 30)),
+    # users moved per transaction and the pause between transactions
+    "ARCHIVE_BATCH_SIZE": lambda: int(os.getenv("ARCHIVE_BATCH_SIZE", 500)),
+    "ARCHIVE_BATCH_PAUSE_SECONDS": lambda: float(
+        os.getenv("ARCHIVE_BATCH_PAUSE_SECONDS", 0.5)
+    ),
+    # how often every app worker runs the archival, 0 leaves it to the CLI
+    "ARCHIVE_INTERVAL_SECONDS": lambda: float(
+        os.getenv("ARCHIVE_INTERVAL_SECONDS", 3600)
+    ),
+    # request profiling, requires pyinstrument; off unless one trigger is set
+    # secret sent in X-Profile by operators to profile that request
+    "PROFILING_TOKEN": lambda: os.getenv("PROFILING_TOKEN", ""),
+    # share of all requests profiled
+    "PROFILING_SAMPLE_RATE": lambda: float(os.getenv("PROFILING_SAMPLE_RATE", 0)),
+    "PROFILING_INTERVAL_SECONDS": lambda: float(
+        os.getenv("PROFILING_INTERVAL_SECONDS", 0.001)
+    ),
+    "PROFILING_DIR": lambda: os.getenv("PROFILING_DIR", "profiles"),
+    # newest profiles kept in PROFILING_DIR
+    "PROFILING_MAX_FILES": lambda: int(os.getenv("PROFILING_MAX_FILES", 100)),
+    # directory where every worker of server.py leaves a snapshot of its
+    # metrics, /metrics then sums them; set by server.py for several workers
+    "METRICS_DIR": lambda: os.getenv("METRICS_DIR", ""),
+    "METRICS_FLUSH_SECONDS": lambda: float(os.getenv("METRICS_FLUSH_SECONDS", 1)),
+    # production server (server.py)
+    "SERVER_HOST": lambda: os.getenv("SERVER_HOST", "0.0.0.0"),
+    "SERVER_PORT": lambda: int(os.getenv("SERVER_PORT", 8000)),
+    "SERVER_WORKERS": lambda: int(os.getenv("SERVER_WORKERS", os.cpu_count() or 1)),
+    # workers server.py actually launched, set by it for the workers; 1 when
+    # the app runs in a single process, e.g. under plain uvicorn
+    "SERVER_WORKER_PROCESSES": lambda: int(os.getenv("SERVER_WORKER_PROCESSES", 1)),
+    "SERVER_LOOP": lambda: os.getenv("SERVER_LOOP", "uvloop"),
+    "SERVER_HTTP": lambda: os.getenv("SERVER_HTTP", "httptools"),
+    "SERVER_BACKLOG": lambda: int(os.getenv("SERVER_BACKLOG", 2048)),
+    # keep longer than the idle timeout of the load balancer in front
+    "SERVER_KEEPALIVE_SECONDS": lambda: int(os.getenv("SERVER_KEEPALIVE_SECONDS", 65)),
+    "SERVER_GRACEFUL_TIMEOUT": lambda: int(os.getenv("SERVER_GRACEFUL_TIMEOUT", 30)),
+    # a worker is replaced after this many requests plus a random jitter, 0 never
+    "SERVER_MAX_REQUESTS": lambda: int(os.getenv("SERVER_MAX_REQUESTS", 10000)),
+    "SERVER_MAX_REQUESTS_JITTER": lambda: int(
+        os.getenv("SERVER_MAX_REQUESTS_JITTER", 1000)
+    ),
+    # login throttling, e.g. off for load tests sending every login from one IP
+    "LOGIN_THROTTLE_ENABLED": lambda: _flag("LOGIN_THROTTLE_ENABLED", "true"),
+    # login attempts allowed per minute and burst size, per email and per client IP
+    "LOGIN_EMAIL_RATE_PER_MINUTE": lambda: int(
+        os.getenv("LOGIN_EMAIL_RATE_PER_MINUTE", 10)
+    ),
+    "LOGIN_EMAIL_BURST": lambda: int(os.getenv("LOGIN_EMAIL_BURST", 5)),
+    "LOGIN_IP_RATE_PER_MINUTE": lambda: int(os.getenv("LOGIN_IP_RATE_PER_MINUTE", 60)),
+    "LOGIN_IP_BURST": lambda: int(os.getenv("LOGIN_IP_BURST", 20)),
+    # keys each limiter remembers before evicting the least recently used ones
+    "LOGIN_THROTTLE_MAX_KEYS": lambda: int(
+        os.getenv("LOGIN_THROTTLE_MAX_KEYS", 100000)
+    ),
+    # password hash schemes, the first one hashes new passwords and any other is
+    # only verified and rehashed on the next successful login
+    "PASSWORD_SCHEMES": lambda: _split(os.getenv("PASSWORD_SCHEMES", "bcrypt")),
+    "BCRYPT_ROUNDS": lambda: int(os.getenv("BCRYPT_ROUNDS", 12)),
+    # argon2id, requires argon2-cffi; memory cost is in KiB
+    "ARGON2_TIME_COST": lambda: int(os.getenv("ARGON2_TIME_COST", 3)),
+    "ARGON2_MEMORY_COST": lambda: int(os.getenv("ARGON2_MEMORY_COST", 65536)),
+    "ARGON2_PARALLELISM": lambda: int(os.getenv("ARGON2_PARALLELISM", 4)),
+}
+
+
+def __getattr__(name: str) -> Any:
+    try:
+        load = _SETTINGS[name]
+    except KeyError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = globals()[name] = load()
+    return value
+
+
+def __dir__() -> list[str]:
+    return [*globals(), *_SETTINGS]